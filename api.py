@@ -0,0 +1,266 @@
+"""Warbler's JSON API, version 1 (mounted at /api/v1 by app.py).
+
+Clients read timelines, profiles, follower lists and likes here rather
+than scraping the HTML pages. The lists come from the same queries as the
+pages and are returned a page at a time:
+
+    {"items": [...], "next_cursor": "..."}
+
+Pass next_cursor back as ?cursor= for the next page; it's null on the
+last one. ?limit= asks for smaller pages than API_PAGE_SIZE.
+
+A client that wants the whole list can ask for application/x-ndjson (in
+Accept, or with ?format=ndjson) instead. The response then streams every
+item from the cursor on, one JSON object per line, fetching a page at a
+time, so neither end holds the whole list.
+
+POST /batch likes, unlikes, follows and unfollows many things at once,
+in one transaction:
+
+    {"like": [message ids], "unlike": [...], "follow": [user ids],
+     "unfollow": [...]}
+
+Each change is idempotent. The response lists the ones that changed
+something, e.g. {"liked": [...], ...}.
+
+Requests are authenticated by the same session cookie as the site.
+"""
+
+import json
+
+from flask import (Blueprint, Response, current_app, g, jsonify, request,
+                   stream_with_context)
+from sqlalchemy import orm
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from pagination import paginate, paginate_ids
+
+NDJSON = 'application/x-ndjson'
+
+# What POST /batch can do: {request key: (response key, method)}
+BATCH_CHANGES = {
+    'like': ('liked', Likes.like),
+    'unlike': ('unliked', Likes.unlike),
+    'follow': ('followed', Follows.follow),
+    'unfollow': ('unfollowed', Follows.unfollow),
+}
+
+api = Blueprint('api', __name__)
+
+
+def user_json(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'image_url': user.image_url,
+        'header_image_url': user.header_image_url,
+        'bio': user.bio,
+    }
+
+
+def profile_json(user):
+    return {
+        **user_json(user),
+        'location': user.location,
+        'messages_count': user.messages_count,
+        'following_count': user.following_count,
+        'followers_count': user.followers_count,
+        'likes_count': user.likes_count,
+    }
+
+
+def message_json(msg):
+    return {
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'likes_count': msg.likes_count,
+        'user': {
+            'id': msg.user.id,
+            'username': msg.user.username,
+            'image_url': msg.user.image_url,
+        },
+    }
+
+
+def wants_ndjson():
+    return (request.args.get('format') == 'ndjson'
+            or request.accept_mimetypes.best_match(
+                ['application/json', NDJSON]) == NDJSON)
+
+
+def page_size():
+    """The page size the client asked for, within API_PAGE_SIZE."""
+
+    per_page = current_app.config['API_PAGE_SIZE']
+    limit = request.args.get('limit', type=int)
+    return max(1, min(limit, per_page)) if limit else per_page
+
+
+def error(message, status):
+    return jsonify(error=message), status
+
+
+def user_exists(user_id):
+    return db.session.scalar(
+        db.select(User.id).where(User.id == user_id)) is not None
+
+
+def respond(fetch, to_json):
+    """Answer with the page of items `fetch(cursor, per_page)` returns, or
+    stream every page from the cursor on as NDJSON.
+
+    `fetch` returns (items, cursor of the following page or None).
+    """
+
+    cursor = request.args.get('cursor')
+
+    if not wants_ndjson():
+        items, next_cursor = fetch(cursor, page_size())
+        return jsonify(items=[to_json(item) for item in items],
+                       next_cursor=next_cursor)
+
+    def lines(cursor):
+        per_page = current_app.config['API_PAGE_SIZE']
+        while True:
+            items, cursor = fetch(cursor, per_page)
+            for item in items:
+                yield json.dumps(to_json(item)) + '\n'
+            if not cursor:
+                return
+
+    return Response(stream_with_context(lines(cursor)), mimetype=NDJSON)
+
+
+def message_pages(query, timestamp_col=Message.timestamp, id_col=Message.id):
+    """A `fetch` for respond() that pages through `query`'s messages,
+    newest first."""
+
+    query = query.options(orm.selectinload(Message.user))
+
+    def fetch(cursor, per_page):
+        page = paginate(query, timestamp_col, id_col, per_page,
+                        before=cursor)
+        return page.items, page.older
+
+    return fetch
+
+
+def user_pages(select, id_col):
+    """A `fetch` for respond() that pages through the user cards of
+    `select` in id order."""
+
+    def fetch(cursor, per_page):
+        try:
+            after = int(cursor) if cursor else None
+        except ValueError:
+            after = None
+        page = paginate_ids(select, id_col, per_page, after=after)
+        return page.items, page.next and str(page.next)
+
+    return fetch
+
+
+@api.route('/timeline')
+def timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    if not g.user:
+        return error("Log in to see your timeline.", 401)
+
+    return respond(message_pages(TimelineEntry.messages_for(g.user.id),
+                                 TimelineEntry.timestamp,
+                                 TimelineEntry.message_id),
+                   message_json)
+
+
+@api.route('/users/<int:user_id>')
+def user_profile(user_id):
+    """A user's profile and counts."""
+
+    user = db.session.get(User, user_id)
+    if not user:
+        return error("No such user.", 404)
+
+    return jsonify(profile_json(user))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    if not user_exists(user_id):
+        return error("No such user.", 404)
+
+    return respond(message_pages(Message.by_author(user_id)), message_json)
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """The users a user follows."""
+
+    if not g.user:
+        return error("Log in to see who people follow.", 401)
+    if not user_exists(user_id):
+        return error("No such user.", 404)
+
+    return respond(user_pages(User.following_cards(user_id),
+                              Follows.user_being_followed_id),
+                   user_json)
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """A user's followers."""
+
+    if not g.user:
+        return error("Log in to see people's followers.", 401)
+    if not user_exists(user_id):
+        return error("No such user.", 404)
+
+    return respond(user_pages(User.follower_cards(user_id),
+                              Follows.user_following_id),
+                   user_json)
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """The messages a user has liked, newest first."""
+
+    if not g.user:
+        return error("Log in to see people's likes.", 401)
+    if not user_exists(user_id):
+        return error("No such user.", 404)
+
+    return respond(message_pages(Message.liked_by(user_id)), message_json)
+
+
+@api.route('/batch', methods=['POST'])
+def batch():
+    """Apply many like and follow changes in one transaction."""
+
+    if not g.user:
+        return error("Log in to like and follow.", 401)
+
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict) or not set(changes) <= set(BATCH_CHANGES):
+        return error(f"Send a JSON object with any of "
+                     f"{', '.join(BATCH_CHANGES)}.", 400)
+
+    for ids in changes.values():
+        if not (isinstance(ids, list)
+                and all(type(id) is int for id in ids)):
+            return error("Each change takes a list of ids.", 400)
+
+    if sum(map(len, changes.values())) > current_app.config['API_MAX_BATCH']:
+        return error(f"At most {current_app.config['API_MAX_BATCH']} "
+                     f"changes at a time.", 400)
+
+    result = {}
+    for key, (changed, apply) in BATCH_CHANGES.items():
+        ids = changes.get(key)
+        if ids:
+            result[changed] = sorted(apply(g.user.id, ids))
+    db.session.commit()
+
+    return jsonify(result)
@@ -1,11 +1,34 @@
+import hashlib
+import hmac
+import json
 import os
+import time
+from datetime import datetime, timedelta
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+import click
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   url_for, abort, has_request_context)
+from markupsafe import Markup
 # from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
-
+from psycopg2.errors import QueryCanceled
+from sqlalchemy import event, orm
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.pool import NullPool
+
+import instrumentation
+import migrations
+import query_plans
+import slow_queries
+from api import api
+from caching import LRUCache, RedisCache, TTLCache
+from instrumentation import RouteMetrics
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileForm
-from models import db, connect_db, User, Message, Likes
+from models import (db, connect_db, User, UserIdentity, Message, Likes, Follows,
+                    TimelineEntry)
+from pagination import paginate, paginate_ids, paginate_numbered
+from passwords import PasswordHasherBusy, hasher
+from replicas import replicas
 
 CURR_USER_KEY = "curr_user"
 
@@ -16,28 +39,271 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# Connection pooling. DB_POOLER=transaction is for running behind a
+# transaction-level pooler such as PgBouncer: the app keeps no connections
+# of its own (the pooler bounds them across every worker) and sets nothing
+# that outlives a transaction.
+app.config['DB_POOLER'] = os.environ.get('DB_POOLER', '')
+# Shown in pg_stat_activity for the app's Postgres connections
+app.config['DB_APPLICATION_NAME'] = os.environ.get('DB_APPLICATION_NAME',
+                                                   'warbler')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+if (make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+        == 'postgresql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {
+        'application_name': app.config['DB_APPLICATION_NAME'],
+    }
+if app.config['DB_POOLER'] == 'transaction':
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'] = NullPool
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 3600)),
+        pool_pre_ping=os.environ.get('DB_POOL_PRE_PING') == '1',
+    )
+
+# Longest a statement may run, in milliseconds (0 for no limit), applied
+# with SET LOCAL to each transaction a request begins.
+# STATEMENT_TIMEOUT_MS_<ENDPOINT> (e.g. STATEMENT_TIMEOUT_MS_MESSAGES_SEARCH)
+# overrides it for one route.
+app.config['STATEMENT_TIMEOUT_MS'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_MS', 0))
+app.config['STATEMENT_TIMEOUTS'] = {
+    key[len('STATEMENT_TIMEOUT_MS_'):].lower(): int(value)
+    for key, value in os.environ.items()
+    if key.startswith('STATEMENT_TIMEOUT_MS_')
+}
+
+# Read replicas (comma-separated URLs). GET, HEAD and OPTIONS requests read
+# from one of them, except for users who have made a change in the last
+# REPLICA_STICKY_SECONDS, whose reads stay on the primary so they see it.
+app.config['DATABASE_REPLICA_URLS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url]
+app.config['REPLICA_STICKY_SECONDS'] = float(
+    os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 100))
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 48))
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 60))
+# Items per page of the JSON API's lists (and per fetch when streaming them)
+app.config['API_PAGE_SIZE'] = int(os.environ.get('API_PAGE_SIZE', 100))
+# Most changes one POST /api/v1/batch may make
+app.config['API_MAX_BATCH'] = int(os.environ.get('API_MAX_BATCH', 1000))
+
+# bcrypt's work factor, and how many hashes may run (BCRYPT_WORKERS) or be
+# running and queued (BCRYPT_MAX_QUEUE, default eight per worker) at once;
+# see passwords.py. Changing the work factor rehashes passwords as their
+# owners log in.
+# BCRYPT_WORKERS defaults to 0, hashing in the request's own thread. Set it
+# for the web server only: each process (e.g. each gunicorn worker) gets its
+# own pool, so keep workers x BCRYPT_WORKERS within the CPUs. The pool's
+# processes re-import the __main__ module, so a script run with it set must
+# guard its top level with `if __name__ == '__main__':`.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', 0))
+app.config['BCRYPT_MAX_QUEUE'] = (
+    int(os.environ['BCRYPT_MAX_QUEUE']) if 'BCRYPT_MAX_QUEUE' in os.environ
+    else None)
+
+# Browsers may reuse static files this many seconds without revalidating.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(
+    os.environ.get('STATIC_MAX_AGE', 3600))
+# Mixed into every page's ETag; change it when a deploy changes the markup
+# so browsers don't keep revalidating pages cached from the old templates.
+app.config['ETAG_SALT'] = os.environ.get('ETAG_SALT', '')
+# Other people's likes don't change the versions ETags are built from, so
+# the like counts on a revalidated page may be up to this many seconds old.
+app.config['LIKE_COUNTS_MAX_AGE'] = int(
+    os.environ.get('LIKE_COUNTS_MAX_AGE', 60))
+
+# Rendered message cards are cached in-process (up to FRAGMENT_CACHE_SIZE of
+# them) unless FRAGMENT_CACHE_URL names a Redis server for the workers to
+# share, where they expire after FRAGMENT_CACHE_TTL seconds.
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 24 * 60 * 60))
+
+# Statements slower than SLOW_QUERY_MS are written to SLOW_QUERY_LOG (a
+# rotating file), with their plans if slower than SLOW_QUERY_EXPLAIN_MS;
+# set SLOW_QUERY_ANALYZE=1 to capture EXPLAIN ANALYZE plans for SELECTs.
+# Summarize the log with `flask slow-queries`.
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 250))
+app.config['SLOW_QUERY_EXPLAIN_MS'] = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_MS', 1000))
+app.config['SLOW_QUERY_ANALYZE'] = os.environ.get('SLOW_QUERY_ANALYZE') == '1'
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG',
+                                              'slow_queries.log')
+
+# Addresses allowed to read /metrics. Behind a proxy on the same host every
+# request comes from 127.0.0.1, so there set METRICS_TOKEN as well: scrapers
+# must then also send it as "Authorization: Bearer <token>".
+app.config['METRICS_ALLOW'] = os.environ.get(
+    'METRICS_ALLOW', '127.0.0.1,::1').split(',')
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# How pages eager-load the related rows they render: 'joined' or 'selectin'.
+# LOADER_STRATEGY_<ENDPOINT> (e.g. LOADER_STRATEGY_HOMEPAGE) overrides the
+# default for a single route so the two can be compared on real data.
+app.config['LOADER_STRATEGY'] = os.environ.get('LOADER_STRATEGY', 'selectin')
+app.config['LOADER_STRATEGIES'] = {
+    key[len('LOADER_STRATEGY_'):].lower(): value
+    for key, value in os.environ.items()
+    if key.startswith('LOADER_STRATEGY_')
+}
+for endpoint, strategy in [(None, app.config['LOADER_STRATEGY']),
+                           *app.config['LOADER_STRATEGIES'].items()]:
+    if strategy not in ('joined', 'selectin'):
+        name = f"LOADER_STRATEGY_{endpoint.upper()}" if endpoint else (
+            "LOADER_STRATEGY")
+        raise ValueError(f"{name} must be 'joined' or 'selectin', "
+                         f"not {strategy!r}")
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 app.app_context().push()
+hasher.configure(rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                 workers=app.config['BCRYPT_WORKERS'],
+                 max_queue=app.config['BCRYPT_MAX_QUEUE'])
+
+# Time SQL, templates and password hashing per request (see the end of this
+# file); registered first so timing starts before the other hooks run.
+route_metrics = RouteMetrics()
+instrumentation.watch_engine(db.engine)
+instrumentation.watch_templates(app)
+hasher.listeners.append(instrumentation.record_bcrypt)
+app.before_request(instrumentation.start_request)
+
+slow_query_log = slow_queries.SlowQueryLog(
+    app.config['SLOW_QUERY_LOG'],
+    threshold_ms=app.config['SLOW_QUERY_MS'],
+    explain_ms=app.config['SLOW_QUERY_EXPLAIN_MS'],
+    analyze=app.config['SLOW_QUERY_ANALYZE'])
+slow_query_log.watch(db.engine)
+
+replicas.listeners += [instrumentation.watch_engine, slow_query_log.watch]
+replicas.configure(app.config['DATABASE_REPLICA_URLS'],
+                   **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+# Methods that only read, and the session key holding the time until which
+# the user's reads must go to the primary.
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+
+@app.before_request
+def route_reads():
+    """Send this request's reads to a replica if it only reads and the user
+    hasn't written anything recently."""
+
+    g.read_replica = None
+    if (replicas.engines and request.method in READ_METHODS
+            and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time()):
+        g.read_replica = replicas.choose()
+
+
+@app.after_request
+def stick_to_primary(response):
+    """Keep a user who has just written reading from the primary until the
+    replicas have caught up."""
+
+    if request.method not in READ_METHODS and replicas.engines:
+        session[PRIMARY_UNTIL_KEY] = (
+            time.time() + app.config['REPLICA_STICKY_SECONDS'])
+    return response
+
+
+def set_statement_timeout(connection):
+    """Apply the current route's statement timeout (0 if it has none) to
+    the transaction on `connection`.
+
+    Set even when it's 0, so a transaction left open by an earlier request
+    doesn't keep that route's timeout. Nothing is set if no timeouts are
+    configured at all.
+    """
+
+    if not (app.config['STATEMENT_TIMEOUT_MS']
+            or app.config['STATEMENT_TIMEOUTS']):
+        return
+
+    timeout = app.config['STATEMENT_TIMEOUTS'].get(
+        request.endpoint, app.config['STATEMENT_TIMEOUT_MS'])
+    connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+@event.listens_for(db.session, 'after_begin')
+def time_out_new_transactions(session, transaction, connection):
+    if has_request_context():
+        set_statement_timeout(connection)
+
+
+@app.before_request
+def time_out_open_transaction():
+    """Cover a transaction left open from before this request (the session
+    outlives requests served from the app context pushed above), on each
+    connection it holds: the primary's and any replica's."""
+
+    transaction = db.session().get_transaction()
+    if transaction is not None:
+        # The session keeps no public list of the connections it holds;
+        # each is listed under both its engine and itself.
+        for connection in {connection for connection, *_ in
+                           transaction._connections.values()}:
+            set_statement_timeout(connection)
 
 ##############################################################################
 # User signup/login/logout
 
 
+# Cached UserIdentity snapshots of logged-in users, keyed by user id.
+identity_cache = TTLCache(ttl=app.config['IDENTITY_CACHE_TTL'])
+
+# Endpoints whose views only use g.user's id, username and avatar.
+IDENTITY_ONLY_ENDPOINTS = set()
+
+
+def identity_only(view):
+    """Mark `view` as needing only the logged-in user's identity.
+
+    For these routes g.user is a UserIdentity rather than a User. Reads
+    take it from identity_cache; writes look the user up, so an account
+    deleted by another worker can't keep writing from its cached identity.
+    """
+
+    IDENTITY_ONLY_ENDPOINTS.add(view.__name__)
+    return view
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-
-    else:
+    if CURR_USER_KEY not in session or request.endpoint == 'static':
         g.user = None
+        return
+
+    user_id = session[CURR_USER_KEY]
+    needs_identity_only = request.endpoint in IDENTITY_ONLY_ENDPOINTS
+
+    if needs_identity_only and request.method in READ_METHODS:
+        g.user = identity_cache.get(user_id)
+        if g.user:
+            return
+
+    user = db.session.get(User, user_id)
+    identity = UserIdentity.of(user) if user else None
+    if identity:
+        identity_cache.set(user_id, identity)
+
+    g.user = identity if needs_identity_only else user
 
 
 def do_login(user):
@@ -53,11 +319,72 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-   
-        
+def eager(*path):
+    """Loader option that eager-loads the relationship `path` (e.g.
+    User.likes, Message.user) using this route's configured strategy."""
+
+    strategy = app.config['LOADER_STRATEGIES'].get(
+        request.endpoint, app.config['LOADER_STRATEGY'])
+
+    option = orm
+    for relationship in path:
+        option = getattr(option, f'{strategy}load')(relationship)
+    return option
+
+
+def liked_ids_for(messages):
+    """Ids of `messages` the logged-in user has liked (empty if anon)."""
+
+    if not g.user:
+        return set()
+
+    return g.user.liked_message_ids([msg.id for msg in messages])
+
+
+def not_modified(*parts):
+    """Give this page an ETag built from `parts`, the versions of whatever
+    it shows, and say whether the browser's cached copy is still current.
+
+    Views check this before doing their real queries and return
+    not_modified_response() when it's true. Pages with a flash message
+    waiting get no ETag, since the message won't be there next time.
+    """
+
+    if '_flashes' in session:
+        return False
+
+    viewer = g.user.id if g.user else 'anon'
+    key = '/'.join(str(part) for part in (
+        app.config['ETAG_SALT'], request.full_path, viewer, *parts))
+    g.etag = hashlib.sha1(key.encode()).hexdigest()
+
+    return request.if_none_match.contains_weak(g.etag)
+
+
+def like_counts_epoch():
+    """ETag part for pages showing like counts: changes every
+    LIKE_COUNTS_MAX_AGE seconds so the counts are refreshed that often."""
+
+    return int(time.time() // max(app.config['LIKE_COUNTS_MAX_AGE'], 1))
+
+
+def not_modified_response():
+    """An empty 304 Not Modified response."""
+
+    return app.response_class(status=304)
+
+
+def following_ids_for(users):
+    """Ids of `users` the logged-in user follows (empty if anon)."""
+
+    if not g.user:
+        return set()
+
+    return g.user.following_ids([user.id for user in users])
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@identity_only
 def signup():
     """Handle user signup.
 
@@ -94,6 +421,7 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@identity_only
 def login():
     """Handle user login."""
 
@@ -104,6 +432,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # Keep the password's hash if authenticate() upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -114,6 +444,7 @@ def login():
 
 
 @app.route('/logout')
+@identity_only
 def logout():
     """Handle logout of user."""
     do_logout()
@@ -124,42 +455,57 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@identity_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and a
+    'page' param to page through the results.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = User.query.order_by(User.username)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = User.search(search)
+
+    users = paginate_numbered(users,
+                              page=request.args.get('page', 1, type=int),
+                              per_page=app.config['USERS_PER_PAGE'])
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users,
+                           following_ids=following_ids_for(users))
 
 
 @app.route('/users/<int:user_id>')
+@identity_only
 def users_show(user_id):
     """Show user profile."""
 
+    viewer_id = g.user.id if g.user else None
+    versions = User.versions(user_id, viewer_id)
+    if user_id in versions and not_modified(versions[user_id],
+                                            versions.get(viewer_id),
+                                            like_counts_epoch()):
+        return not_modified_response()
+
     user = User.query.get_or_404(user_id)
     
     # snagging messages in order from the database;
     # user.messages won't be in order by default
     
-    messages = (Message
-                .query
-                .filter(Message.user_id == user.id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    likes = len(user.likes) 
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    messages = paginate(Message.by_author(user.id),
+                        Message.timestamp, Message.id,
+                        per_page=app.config['MESSAGES_PER_PAGE'],
+                        before=request.args.get('before'),
+                        after=request.args.get('after'))
+    return render_template('users/show.html', user=user, messages=messages,
+                           liked_ids=liked_ids_for(messages))
 
 
 @app.route('/users/<int:user_id>/following')
+@identity_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -168,10 +514,18 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users = paginate_ids(User.following_cards(user.id),
+                         Follows.user_being_followed_id,
+                         per_page=app.config['USERS_PER_PAGE'],
+                         before=request.args.get('before', type=int),
+                         after=request.args.get('after', type=int))
+
+    return render_template('users/following.html', user=user, users=users,
+                           following_ids=following_ids_for(users))
 
 
 @app.route('/users/<int:user_id>/followers')
+@identity_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -180,10 +534,18 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users = paginate_ids(User.follower_cards(user.id),
+                         Follows.user_following_id,
+                         per_page=app.config['USERS_PER_PAGE'],
+                         before=request.args.get('before', type=int),
+                         after=request.args.get('after', type=int))
+
+    return render_template('users/followers.html', user=user, users=users,
+                           following_ids=following_ids_for(users))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@identity_only
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -191,14 +553,16 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if not Follows.follow(g.user.id, [follow_id]):
+        # Already following, unless there's no such user
+        User.query.get_or_404(follow_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@identity_only
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -206,50 +570,63 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    Follows.unfollow(g.user.id, [follow_id])
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 @app.route('/users/add_like/<int:message_id>', methods=["POST"])
+@identity_only
 def add_like(message_id):
     """Add a like to liked warbles"""
-    try:
-        Likes.add_like(user_id=g.user.id,
-                                message_id=message_id)
-        
-        db.session.commit()
 
-        url = url_for('messages_show', message_id=message_id)   
-        return redirect(url)
-    
-    except IntegrityError:
-            flash("You already liked this message!", 'danger')
-            return redirect('/')
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    liked = Likes.like(g.user.id, [message_id])
+    db.session.commit()
+
+    if liked:
+        return redirect(url_for('messages_show', message_id=message_id))
+
+    msg = Message.query.get_or_404(message_id)
+    if msg.user_id == g.user.id:
+        flash("You can't like your own message.", 'danger')
+    else:
+        flash("You already liked this message!", 'danger')
+    return redirect('/')
     
 @app.route('/users/<int:user_id>/likes')
+@identity_only
 def show_likes(user_id):
     """Show list of user's liked warbles"""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = (User
+            .query
+            .options(eager(User.likes, Message.user))
+            .get_or_404(user_id))
     likes = user.likes
 
-    return render_template('/users/likes.html', likes=likes)
+    return render_template('/users/likes.html', likes=likes,
+                           liked_ids=liked_ids_for(likes))
 
 @app.route('/users/delete_like/<int:message_id>', methods=["POST"])
+@identity_only
 def delete_like(message_id):
     """Delete a previously liked warble"""
-    liked_msg_id=Message.query.get(message_id)
-    likes_list=g.user.likes
-    if liked_msg_id and g.user.id:
-        likes_list.remove(liked_msg_id)
-        db.session.commit()
-        flash("You removed the liked message", "success")
-        return redirect('/')
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    Likes.unlike(g.user.id, [message_id])
+    db.session.commit()
+    flash("You removed the liked message", "success")
+    return redirect('/')
 
 
 @app.route('/users/profile/<int:user_id>/edit', methods=["GET", "POST"])
@@ -263,7 +640,7 @@ def profile(user_id):
     form = EditProfileForm(obj=g.user)
   
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
+        user = User.authenticate(g.user.username,
                                  form.password.data)
         if user:
             user.username = form.username.data
@@ -272,8 +649,13 @@ def profile(user_id):
             user.header_image_url = form.header_image_url.data
             user.bio = form.bio.data
             user.location = form.location.data
-        
+            user.profile_version = User.profile_version + 1
+
+            # Followers' timelines show this user's name and avatar
+            User.touch(db.select(Follows.user_following_id)
+                       .where(Follows.user_being_followed_id == user.id))
             db.session.commit()
+            identity_cache.delete(user.id)
             flash ("You updated your profile", "success")
             return redirect(f"/users/{user.id}")
         else:
@@ -284,22 +666,77 @@ def profile(user_id):
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
-    user = User.query.get_or_404(id)
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-   
-    
-    db.session.delete(g.user)
+
+    user_id = g.user.id
+
+    # Everyone whose counters include this user's follows or messages
+    affected_ids = db.session.scalars(
+        db.select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id)
+        .union(db.select(Follows.user_following_id)
+               .where(Follows.user_being_followed_id == user_id),
+               db.select(Likes.user_id)
+               .join(Message, Message.id == Likes.message_id)
+               .where(Message.user_id == user_id))).all()
+
+    # The messages this user liked each lose a like
+    Message.adjust_likes(db.select(Likes.message_id)
+                         .where(Likes.user_id == user_id), -1)
+    # By key, leaving the user's follows, likes, messages and timeline
+    # entries to the foreign keys' ON DELETE CASCADE rather than loading
+    # them into the session
+    db.session.execute(db.delete(User).where(User.id == user_id))
+    User.reconcile_counts(affected_ids)
     db.session.commit()
 
+    identity_cache.delete(user_id)
+    do_logout()
+
     return redirect("/signup")
 
 
 ##############################################################################
 # Messages routes:
 
+
+if app.config['FRAGMENT_CACHE_URL']:
+    fragment_cache = RedisCache(app.config['FRAGMENT_CACHE_URL'],
+                                ttl=app.config['FRAGMENT_CACHE_TTL'])
+else:
+    fragment_cache = LRUCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'])
+
+
+def card_key(message_id, profile_version):
+    """Fragment cache key for a message card.
+
+    Cards show the author's name and avatar, so the key includes their
+    profile_version: editing a profile moves the author's cards to new
+    keys and the old ones age out of the cache.
+    """
+
+    return f"message-card:{message_id}:{profile_version}"
+
+
+@app.template_global()
+def message_card(msg):
+    """The markup for `msg` in a list of messages, minus the viewer's like
+    button, rendered once and then served from the fragment cache."""
+
+    key = card_key(msg.id, msg.user.profile_version)
+    html = fragment_cache.get(key)
+
+    if html is None:
+        html = render_template('messages/card.html', msg=msg)
+        fragment_cache.set(key, html)
+
+    return Markup(html)
+
+
 @app.route('/messages/new', methods=["GET", "POST"])
+@identity_only
 def messages_add():
     """Add a message:
 
@@ -313,8 +750,11 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        User.adjust_counts(g.user.id, messages_count=1)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -322,15 +762,69 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+def parse_date(value):
+    """Parse a YYYY-MM-DD query string value (ValueError if malformed)."""
+
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+@app.route('/messages/search')
+@identity_only
+def messages_search():
+    """Search warbles by text.
+
+    Takes 'q' (the search terms), and optionally 'author' (a username) and
+    'since' / 'until' (YYYY-MM-DD, inclusive) to narrow the results, which
+    are paged newest first.
+    """
+
+    terms = request.args.get('q', '').strip()
+    author = request.args.get('author', '').strip()
+    since = request.args.get('since', type=parse_date)
+    until = request.args.get('until', type=parse_date)
+
+    messages = []
+
+    if terms:
+        author_id = None
+        if author:
+            author_id = db.session.scalar(
+                db.select(User.id).where(User.username == author))
+
+        if author_id or not author:
+            query = Message.search(
+                terms,
+                author_id=author_id,
+                since=since,
+                until=until + timedelta(days=1) if until else None)
+
+            messages = paginate(query.options(eager(Message.user)),
+                                Message.timestamp, Message.id,
+                                per_page=app.config['MESSAGES_PER_PAGE'],
+                                before=request.args.get('before'),
+                                after=request.args.get('after'))
+
+    return render_template('messages/search.html', messages=messages,
+                           liked_ids=liked_ids_for(messages))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@identity_only
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+
+    viewer_id = g.user.id if g.user else None
+    versions = User.versions(msg.user_id, viewer_id)
+    if not_modified(versions.get(msg.user_id), versions.get(viewer_id)):
+        return not_modified_response()
+
     return render_template('messages/show.html', message=msg)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@identity_only
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -338,9 +832,20 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+    if msg.user_id != g.user.id:
+        abort(403)
+
+    key = card_key(msg.id, msg.user.profile_version)
+    User.adjust_counts(msg.user_id, messages_count=-1)
+    User.adjust_counts(db.select(Likes.user_id)
+                       .where(Likes.message_id == msg.id),
+                       likes_count=-1)
+    User.touch(db.select(TimelineEntry.user_id)
+               .where(TimelineEntry.message_id == msg.id))
     db.session.delete(msg)
     db.session.commit()
+    fragment_cache.delete(key)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -354,37 +859,199 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, read from the
+      user's materialized timeline a page at a time
     """
 
     if g.user:
-        user_ids = [user.id for user in g.user.following] + [g.user.id]
-        messages = (Message
-                .query
-                .filter(Message.user_id.in_(user_ids))
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-
-        return render_template('home.html', messages=messages)
+        versions = User.versions(g.user.id)
+        if not_modified(versions.get(g.user.id), TimelineEntry.head(g.user.id),
+                        like_counts_epoch()):
+            return not_modified_response()
+
+        messages = paginate(TimelineEntry
+                            .messages_for(g.user.id)
+                            .options(eager(Message.user)),
+                            TimelineEntry.timestamp, TimelineEntry.message_id,
+                            per_page=app.config['MESSAGES_PER_PAGE'],
+                            before=request.args.get('before'),
+                            after=request.args.get('after'))
+
+        return render_template('home.html', messages=messages,
+                               liked_ids=liked_ids_for(messages))
 
     else:
+        if not_modified():
+            return not_modified_response()
+
         return render_template('home-anon.html')
 
 
+@app.errorhandler(OperationalError)
+def statement_timed_out(error):
+    """Answer 503 when a statement hits the route's statement timeout."""
+
+    if not isinstance(error.orig, QueryCanceled):
+        raise error
+
+    db.session.rollback()
+    return ("That took too long; please try again in a moment.", 503,
+            {'Retry-After': '1'})
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Turn away sign-ups and logins while the password hasher is full."""
+
+    return ("Too many people are signing in right now; "
+            "please try again in a moment.", 503, {'Retry-After': '1'})
+
+
+##############################################################################
+# JSON API (see api.py)
+
+app.register_blueprint(api, url_prefix='/api/v1')
+
+# Its views only use the logged-in user's id
+IDENTITY_ONLY_ENDPOINTS.update(
+    endpoint for endpoint in app.view_functions
+    if endpoint.startswith('api.'))
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Maintenance commands
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every user's materialized home timeline."""
+
+    TimelineEntry.rebuild()
+    User.touch(db.select(User.id))
+    db.session.commit()
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Repair drift in users' denormalized follower/message/like counts
+    and messages' like counts (safe to run periodically, e.g. from cron)."""
+
+    fixed = User.reconcile_counts()
+    db.session.commit()
+    print(f"Reconciled counters for {fixed} user(s).")
+
+    fixed = Message.reconcile_likes_counts()
+    db.session.commit()
+    print(f"Reconciled like counts for {fixed} message(s).")
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Apply pending schema migrations."""
+
+    applied = migrations.upgrade()
+    for name in applied:
+        print(f"Applied {name}")
+    print(f"Schema is at version {len(migrations.MIGRATIONS)}.")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail if any hot route's query can only be planned as a seq scan."""
+
+    failures = query_plans.check()
+    for name, tables in failures.items():
+        print(f"{name}: sequential scan on {', '.join(tables)}")
+
+    if failures:
+        raise SystemExit(1)
+    print("All hot queries are index-backed.")
+
+
+@app.cli.command('slow-queries')
+@click.option('--top', default=10, help="How many statements to show.")
+@click.option('--sort', type=click.Choice(['total', 'max', 'count']),
+              default='total', help="Rank by total time, worst time or count.")
+@click.option('--plans', is_flag=True, help="Show each one's slowest plan.")
+def slow_queries_report(top, sort, plans):
+    """Summarize the slow-query log by statement fingerprint."""
+
+    groups = slow_queries.summarize(
+        slow_queries.read_entries(app.config['SLOW_QUERY_LOG']), sort=sort)
+
+    for group in groups[:top]:
+        print(f"{group['fingerprint']}  {group['count']} times, "
+              f"{group['total_ms']:.0f} ms total, {group['max_ms']:.0f} ms max"
+              f"  [{', '.join(sorted(group['routes'])) or 'no route'}]")
+        print(f"    {' '.join(group['statement'].split())[:300]}")
+        if plans and group['plan']:
+            print(json.dumps(group['plan'], indent=2))
+
+    if not groups:
+        print("No slow queries logged.")
+
+
+##############################################################################
+# Response caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages that call not_modified() carry an ETag and are revalidated on every
+# visit, answering 304 while nothing they show has changed; everything else
+# (forms, redirects, pages without validators) is never stored. Static files
+# keep the ETag, Last-Modified and max-age Flask gives them.
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Set the caching headers for this response."""
+
+    # g outlives the request when the app context is shared (as it is in
+    # the tests), so take the ETag off it.
+    etag = g.pop('etag', None)
+
+    if request.endpoint == 'static':
+        return response
+
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+    else:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+
+    return response
+
+
+##############################################################################
+# Instrumentation
+
+
+@app.after_request
+def add_server_timing(response):
+    """Report where the request's time went and add it to the metrics."""
+
+    timings = instrumentation.current()
+    if timings and request.endpoint != 'metrics':
+        response.headers['Server-Timing'] = timings.server_timing()
+        route_metrics.observe(request.endpoint or 'unmatched',
+                              response.status_code, timings)
+
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Per-route request metrics and connection pool stats, for Prometheus
+    (only from the addresses in METRICS_ALLOW, with METRICS_TOKEN if set)."""
+
+    if request.remote_addr not in app.config['METRICS_ALLOW']:
+        abort(404)
+
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(
+            request.headers.get('Authorization', '').encode(),
+            f"Bearer {token}".encode()):
+        abort(404)
+
+    return app.response_class(route_metrics.render(db.engine.pool),
+                              mimetype='text/plain; version=0.0.4')
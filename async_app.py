@@ -0,0 +1,118 @@
+"""Asyncio serving for Warbler's read-heavy pages.
+
+    hypercorn async_app:app --workers 2
+
+Serves GETs of the homepage, profiles, single messages and the follower
+pages. The proxy in front sends those here and everything else to the
+Flask app under gunicorn.
+
+Each request runs the Flask app's own view, hooks and templates, but its
+database session talks to Postgres through asyncpg on SQLAlchemy's async
+engine. So while one page waits on a query, the worker's event loop gets
+on with the others, and a single process keeps many queries in flight
+where a sync worker would sit idle waiting for each.
+
+ASYNC_DATABASE_URL sets the database; by default it's DATABASE_URL using
+the asyncpg driver. ASYNC_POOL_SIZE and ASYNC_MAX_OVERFLOW size its pool.
+Each transaction gets its route's statement timeout, as in the Flask app.
+
+Every read goes to ASYNC_DATABASE_URL: DATABASE_REPLICA_URLS and the
+Flask app's read-your-writes stickiness don't apply here. It can point at
+a replica, since these pages only read, but then users may briefly not
+see their own changes on them.
+"""
+
+import os
+
+from quart import Quart, Response, request
+from sqlalchemy import event, orm
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.test import EnvironBuilder
+
+import instrumentation
+from app import app as flask_app, slow_query_log, time_out_new_transactions
+from models import db
+
+# The Flask endpoints served here
+READ_ENDPOINTS = ('homepage', 'users_show', 'messages_show',
+                  'show_following', 'users_followers')
+
+app = Quart(__name__)
+app.config.from_mapping(flask_app.config)
+
+app.config['ASYNC_DATABASE_URL'] = os.environ.get(
+    'ASYNC_DATABASE_URL',
+    make_url(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+    .set(drivername='postgresql+asyncpg')
+    .render_as_string(hide_password=False))
+
+engine_options = dict(
+    pool_size=int(os.environ.get('ASYNC_POOL_SIZE', 20)),
+    max_overflow=int(os.environ.get('ASYNC_MAX_OVERFLOW', 10)),
+    pool_pre_ping=flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'].get(
+        'pool_pre_ping', False),
+    connect_args={'server_settings': {
+        'application_name': flask_app.config['DB_APPLICATION_NAME'],
+    }},
+)
+
+engine = create_async_engine(app.config['ASYNC_DATABASE_URL'],
+                             **engine_options)
+
+
+class RequestSession(orm.Session):
+    """The sync face of the async sessions, which sets each transaction's
+    statement timeout as the Flask app's session does."""
+
+
+event.listen(RequestSession, 'after_begin', time_out_new_transactions)
+
+Session = async_sessionmaker(engine, sync_session_class=RequestSession)
+
+instrumentation.watch_engine(engine.sync_engine)
+slow_query_log.watch(engine.sync_engine)
+
+
+def render(session, environ):
+    """Run the Flask app for `environ` with `session` (the sync face of an
+    AsyncSession) as its db.session, and return its response.
+
+    Called through AsyncSession.run_sync, so each query the view makes
+    awaits asyncpg on the event loop. A fresh app context keeps this
+    request's g and db.session apart from the others in flight.
+    """
+
+    with flask_app.app_context():
+        db.session.registry.set(session)
+        return flask_app.response_class.from_app(flask_app.wsgi_app, environ)
+
+
+async def serve(**view_args):
+    """Answer the current request with the Flask view for its endpoint."""
+
+    environ = EnvironBuilder(
+        path=request.path,
+        base_url=f"{request.scheme}://{request.host}{request.root_path}",
+        query_string=request.query_string.decode(),
+        method=request.method,
+        headers=list(request.headers.items()),
+        environ_base={'REMOTE_ADDR': request.remote_addr},
+    ).get_environ()
+
+    async with Session() as session:
+        response = await session.run_sync(render, environ)
+
+    return Response(response.get_data(), status=response.status_code,
+                    headers=list(response.headers.items()))
+
+
+for rule in flask_app.url_map.iter_rules():
+    if rule.endpoint in READ_ENDPOINTS:
+        app.add_url_rule(rule.rule, rule.endpoint, serve,
+                         methods=['GET', 'HEAD'])
+
+
+@app.after_serving
+async def dispose_engine():
+    await engine.dispose()
@@ -0,0 +1,312 @@
+"""Route benchmarks for Warbler at several dataset sizes.
+
+    python benchmark.py --scale 1k --scale 100k
+    python benchmark.py --scale 100k --compare benchmarks/results/<earlier>.json
+
+For each scale this generates a dataset with generator/create_csvs.py
+(kept in benchmarks/data/<scale> for next time) and loads it with seed.py
+into BENCHMARK_DATABASE_URL (default postgresql:///warbler-bench, which
+must already exist; it's wiped). Then it drives the hot routes through
+Flask's test client, logged in as a mix of popular and ordinary users,
+and records each request's latency, SQL statement count and rows fetched.
+
+A summary per route is printed and saved as JSON in benchmarks/results/,
+named by date, scale and git commit; --compare prints the change from an
+earlier result file at the same scale.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from random import Random
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCHMARK_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Likes, Follows
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(HERE, 'benchmarks', 'data')
+RESULTS_DIR = os.path.join(HERE, 'benchmarks', 'results')
+
+# Dataset sizes, named by their message count
+SCALES = {
+    '1k': dict(users=100, messages=1000, follows=2000, likes=2000),
+    '100k': dict(users=10000, messages=100000, follows=300000, likes=200000),
+    '1m': dict(users=100000, messages=1000000, follows=3000000,
+               likes=2000000),
+}
+
+PERCENTILES = (50, 90, 99)
+
+
+class QueryCounter:
+    """Counts the statements run and rows fetched while `active`."""
+
+    def __init__(self, engine):
+        self.active = False
+        self.reset()
+        event.listen(engine, 'before_cursor_execute', self.before)
+        event.listen(engine, 'after_cursor_execute', self.after)
+
+    def reset(self):
+        self.queries = 0
+        self.rows = 0
+
+    def before(self, conn, cursor, statement, parameters, context, many):
+        if self.active:
+            self.queries += 1
+
+    def after(self, conn, cursor, statement, parameters, context, many):
+        if self.active and cursor.description is not None:
+            self.rows += max(cursor.rowcount, 0)
+
+
+class Scenario:
+    """Picks the users and targets each benchmarked request uses."""
+
+    def __init__(self, seed, viewers=20):
+        self.rng = Random(seed)
+        user_ids = db.session.scalars(db.select(User.id)).all()
+        popular = db.session.scalars(
+            db.select(User.id).order_by(User.followers_count.desc(),
+                                        User.id).limit(viewers // 4)).all()
+        self.user_ids = user_ids
+        self.viewers = popular + self.rng.sample(
+            user_ids, min(len(user_ids), viewers - len(popular)))
+        self.max_message_id = db.session.scalar(
+            db.select(db.func.max(Message.id)))
+
+    def viewer(self):
+        return self.rng.choice(self.viewers)
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def unliked_message(self, viewer):
+        """A message by someone else that `viewer` hasn't liked."""
+
+        while True:
+            message = db.session.get(
+                Message, self.rng.randint(1, self.max_message_id))
+            if message and message.user_id != viewer and not (
+                    Likes.query.filter_by(user_id=viewer,
+                                          message_id=message.id).count()):
+                return message.id
+
+    def unfollowed_user(self, viewer):
+        """Someone `viewer` doesn't follow."""
+
+        while True:
+            user_id = self.user()
+            if user_id != viewer and not Follows.query.filter_by(
+                    user_following_id=viewer,
+                    user_being_followed_id=user_id).count():
+                return user_id
+
+
+def routes(scenario):
+    """{route: make_request}, where make_request() returns (viewer,
+    method, url, cleanup url or None) for one request."""
+
+    def get(url):
+        def make():
+            viewer = scenario.viewer()
+            return viewer, 'GET', url(viewer), None
+        return make
+
+    def add_like():
+        viewer = scenario.viewer()
+        message_id = scenario.unliked_message(viewer)
+        return (viewer, 'POST', f'/users/add_like/{message_id}',
+                f'/users/delete_like/{message_id}')
+
+    def add_follow():
+        viewer = scenario.viewer()
+        user_id = scenario.unfollowed_user(viewer)
+        return (viewer, 'POST', f'/users/follow/{user_id}',
+                f'/users/stop-following/{user_id}')
+
+    return {
+        'homepage': get(lambda viewer: '/'),
+        'users_show': get(lambda viewer: f'/users/{scenario.user()}'),
+        'list_users': get(lambda viewer: '/users'),
+        'show_likes': get(lambda viewer: f'/users/{scenario.user()}/likes'),
+        'add_like': add_like,
+        'add_follow': add_follow,
+    }
+
+
+def percentile(values, p):
+    """The nearest-rank `p`th percentile of `values`."""
+
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+
+def summarize(samples):
+    """Latency percentiles (ms), statement and row counts for a route."""
+
+    latencies = [sample['ms'] for sample in samples]
+    summary = {f'p{p}_ms': round(percentile(latencies, p), 2)
+               for p in PERCENTILES}
+    summary.update(
+        requests=len(samples),
+        mean_ms=round(sum(latencies) / len(latencies), 2),
+        max_ms=round(max(latencies), 2),
+        queries_mean=round(sum(s['queries'] for s in samples)
+                           / len(samples), 1),
+        queries_max=max(s['queries'] for s in samples),
+        rows_mean=round(sum(s['rows'] for s in samples) / len(samples), 1),
+        rows_max=max(s['rows'] for s in samples),
+        statuses=sorted({s['status'] for s in samples}),
+    )
+    return summary
+
+
+def run_routes(requests, warmup=5, seed='warbler', only=None):
+    """Benchmark each route with `requests` measured requests (after
+    `warmup` unmeasured ones); return {route: summary}."""
+
+    counter = QueryCounter(db.engine)
+    scenario = Scenario(seed)
+    client = app.test_client()
+    results = {}
+
+    for name, make_request in routes(scenario).items():
+        if only and name not in only:
+            continue
+
+        samples = []
+        for i in range(warmup + requests):
+            viewer, method, url, cleanup = make_request()
+            db.session.rollback()
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = viewer
+
+            counter.reset()
+            counter.active = True
+            started = time.perf_counter()
+            response = client.open(url, method=method)
+            elapsed = time.perf_counter() - started
+            counter.active = False
+
+            if cleanup:
+                client.post(cleanup)
+
+            if i >= warmup:
+                samples.append(dict(ms=elapsed * 1000,
+                                    queries=counter.queries,
+                                    rows=counter.rows,
+                                    status=response.status_code))
+
+        results[name] = summarize(samples)
+
+    return results
+
+
+def seed_dataset(scale):
+    """Generate (if needed) and load the dataset for `scale`."""
+
+    directory = os.path.join(DATA_DIR, scale)
+    if not os.path.exists(os.path.join(directory, 'likes.csv')):
+        sizes = SCALES[scale]
+        subprocess.run(
+            [sys.executable, os.path.join(HERE, 'generator', 'create_csvs.py'),
+             '--out', directory, '--seed', scale, '--end', '2024-01-01',
+             *[f'--{name}={value}' for name, value in sizes.items()]],
+            check=True)
+
+    subprocess.run([sys.executable, os.path.join(HERE, 'seed.py')],
+                   env={**os.environ, 'SEED_DIR': directory},
+                   cwd=HERE, check=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save(result):
+    """Write `result` to benchmarks/results/; return the path."""
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(
+        RESULTS_DIR,
+        f"{result['started_at'][:19].replace(':', '')}"
+        f"-{result['scale']}-{result['commit']}.json")
+
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+    return path
+
+
+def report(result, baseline=None):
+    """Print a table of `result`, with changes from `baseline` if given."""
+
+    print(f"\n{result['scale']} dataset ({result['commit']})")
+    print(f"{'route':<12} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+          f"{'queries':>8} {'rows':>9}")
+
+    for name, summary in result['routes'].items():
+        line = (f"{name:<12} {summary['p50_ms']:>9.1f} "
+                f"{summary['p90_ms']:>9.1f} {summary['p99_ms']:>9.1f} "
+                f"{summary['queries_mean']:>8.1f} {summary['rows_mean']:>9.1f}")
+
+        before = baseline and baseline['routes'].get(name)
+        if before:
+            change = (summary['p50_ms'] / before['p50_ms'] - 1) * 100
+            line += (f"   p50 {change:+.0f}%, queries "
+                     f"{summary['queries_mean'] - before['queries_mean']:+.1f}")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', action='append', choices=SCALES,
+                        help="dataset size to run (repeatable; default 1k)")
+    parser.add_argument('--route', action='append',
+                        help="only benchmark these routes (repeatable)")
+    parser.add_argument('--requests', type=int, default=100,
+                        help="measured requests per route")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="use the data already in the database")
+    parser.add_argument('--compare', help="earlier result file to compare to")
+    options = parser.parse_args()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+
+    for scale in options.scale or ['1k']:
+        if not options.skip_seed:
+            seed_dataset(scale)
+
+        result = dict(scale=scale,
+                      dataset=SCALES[scale],
+                      commit=git_commit(),
+                      started_at=datetime.now().isoformat(),
+                      routes=run_routes(options.requests, options.warmup,
+                                        only=options.route))
+
+        report(result, baseline if baseline and baseline['scale'] == scale
+               else None)
+        print(f"Saved {save(result)}")
+
+
+if __name__ == '__main__':
+    main()
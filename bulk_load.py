@@ -0,0 +1,226 @@
+"""Streaming bulk loader for CSV data, used by seed.py.
+
+`load({'users': 'users.csv', ...})` loads each table from a CSV file whose
+header row names its columns. Rows are read and sent in chunks of
+`chunk_size`, so memory use doesn't grow with the file, using COPY on
+Postgres (psycopg2) and batched INSERTs elsewhere.
+
+To make the load itself as cheap as possible, the tables' secondary
+indexes and their unique and foreign key constraints are dropped first
+and rebuilt once the data is in. That also means the tables don't depend
+on each other during the load, so each is loaded on its own connection in
+parallel. Rows that break a constraint are only caught when it's rebuilt,
+which fails the load.
+
+Progress and throughput are reported through `report` (print by default).
+"""
+
+import csv
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from models import db
+
+CHUNK_SIZE = 50000
+
+
+def load(files, chunk_size=CHUNK_SIZE, report=print):
+    """Load each table named in `files` from its CSV file; return the
+    number of rows loaded per table."""
+
+    engine = db.engine
+    tables = [db.metadata.tables[name] for name in files]
+    started = time.perf_counter()
+
+    with engine.begin() as connection:
+        deferred = drop_deferrable(connection, tables)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(tables)) as pool:
+            futures = {table.name: pool.submit(load_table, engine, table,
+                                               files[table.name], chunk_size,
+                                               report)
+                       for table in tables}
+            counts = {name: future.result()
+                      for name, future in futures.items()}
+
+    finally:
+        report("Rebuilding indexes and constraints...")
+        restore(engine, deferred)
+
+    with engine.begin() as connection:
+        for table in tables:
+            fix_sequences(connection, table)
+            if connection.dialect.name == 'postgresql':
+                connection.exec_driver_sql(f"ANALYZE {table.name}")
+
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    report(f"Loaded {total:,} rows in {elapsed:.1f}s "
+           f"({total / elapsed:,.0f} rows/s)")
+
+    return counts
+
+
+def load_table(engine, table, path, chunk_size, report):
+    """Stream `path` into `table` in chunks; return the number of rows."""
+
+    with open(path, newline='') as file, engine.begin() as connection:
+        reader = csv.reader(file)
+        header = next(reader)
+        defaults = missing_defaults(table, header)
+        columns = header + [name for name, default in defaults]
+
+        copy = connection.dialect.driver == 'psycopg2'
+        count = 0
+        started = time.perf_counter()
+
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                break
+
+            if defaults:
+                chunk = [row + [default() for name, default in defaults]
+                         for row in chunk]
+
+            if copy:
+                copy_rows(connection, table, columns, chunk)
+            else:
+                connection.execute(table.insert(),
+                                   [dict(zip(columns, row)) for row in chunk])
+
+            count += len(chunk)
+            elapsed = time.perf_counter() - started
+            report(f"{table.name}: {count:,} rows "
+                   f"({count / elapsed:,.0f} rows/s)")
+
+    return count
+
+
+def copy_rows(connection, table, columns, rows):
+    """Send `rows` to `table` with a Postgres COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) "
+            f"FROM STDIN WITH (FORMAT csv)",
+            buffer)
+    finally:
+        cursor.close()
+
+
+def missing_defaults(table, header):
+    """(name, make_value) for the columns of `table` missing from `header`
+    whose defaults are only applied by SQLAlchemy, not the database."""
+
+    defaults = []
+    for column in table.columns:
+        if (column.name in header or column.default is None
+                or column.server_default is not None):
+            continue
+
+        default = column.default
+        if default.is_scalar:
+            defaults.append((column.name, lambda value=default.arg: value))
+        elif default.is_callable:
+            defaults.append((column.name, lambda arg=default.arg: arg(None)))
+
+    return defaults
+
+
+def drop_deferrable(connection, tables):
+    """Drop the secondary indexes and the unique and foreign key
+    constraints of `tables`.
+
+    Returns the DDL that recreates them as {table name: (statements for
+    the indexes and unique constraints, statements for the foreign keys)}.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        return {}
+
+    deferred = {}
+    drops = {'f': [], 'other': []}
+
+    for table in tables:
+        constraints = connection.execute(db.text("""
+            SELECT conname, contype, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = CAST(:table AS regclass)
+              AND contype IN ('u', 'f')
+        """), {'table': table.name}).all()
+
+        indexes = connection.execute(db.text("""
+            SELECT CAST(indexrelid AS regclass), pg_get_indexdef(indexrelid)
+            FROM pg_index
+            WHERE indrelid = CAST(:table AS regclass)
+              AND NOT indisprimary
+              AND indexrelid NOT IN (SELECT conindid FROM pg_constraint
+                                     WHERE conrelid = indrelid)
+        """), {'table': table.name}).all()
+
+        add = {kind: [f"ALTER TABLE {table.name} "
+                      f"ADD CONSTRAINT {name} {definition}"
+                      for name, other, definition in constraints
+                      if other == kind]
+               for kind in ('u', 'f')}
+        deferred[table.name] = (
+            [definition for name, definition in indexes] + add['u'],
+            add['f'])
+
+        for name, kind, definition in constraints:
+            drops['f' if kind == 'f' else 'other'].append(
+                f"ALTER TABLE {table.name} DROP CONSTRAINT {name}")
+        drops['other'].extend(f"DROP INDEX {name}" for name, definition
+                              in indexes)
+
+    # Foreign keys first, since they may depend on a unique constraint
+    for statement in drops['f'] + drops['other']:
+        connection.exec_driver_sql(statement)
+
+    return deferred
+
+
+def restore(engine, deferred):
+    """Run the DDL from drop_deferrable(): each table's indexes and unique
+    constraints in parallel, then the foreign keys."""
+
+    def run(statements):
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+
+    with ThreadPoolExecutor(max_workers=max(len(deferred), 1)) as pool:
+        for future in [pool.submit(run, indexes)
+                       for indexes, foreign_keys in deferred.values()]:
+            future.result()
+
+    run([statement for indexes, foreign_keys in deferred.values()
+         for statement in foreign_keys])
+
+
+def fix_sequences(connection, table):
+    """Move `table`'s serial sequences past the ids loaded into it."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    for column in table.primary_key.columns:
+        sequence = connection.scalar(
+            db.text("SELECT pg_get_serial_sequence(:table, :column)"),
+            {'table': table.name, 'column': column.name})
+
+        if sequence:
+            connection.execute(db.text(f"""
+                SELECT setval(:sequence, coalesce(max({column.name}), 1),
+                              max({column.name}) IS NOT NULL)
+                FROM {table.name}
+            """), {'sequence': sequence})
@@ -0,0 +1,146 @@
+"""Caches used by the Warbler app.
+
+TTLCache and LRUCache live in the worker process. RedisCache is a shared
+store for deployments running several workers; it needs the `redis`
+package, which isn't in requirements.txt.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache:
+    """A size-bounded cache whose entries expire `ttl` seconds after they
+    were set.
+
+    Safe to share between the threads of one worker process. Each process
+    has its own copy, so entries invalidated in one worker can live on in
+    the others until they expire; keep `ttl` short.
+    """
+
+    def __init__(self, ttl, maxsize=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the live value for `key`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                return None
+
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the oldest entry if full."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drop `key` if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LRUCache:
+    """A size-bounded cache that evicts the least recently used entry.
+
+    Entries never expire, so only cache values whose key changes when they
+    would (e.g. a key that includes a version number). Thread-safe, and
+    per-process like TTLCache.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the value for `key`, or None."""
+
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used
+        entry if full."""
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drop `key` if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """A cache of strings in Redis, shared by every worker using `url`.
+
+    Entries expire after `ttl` seconds (never if None); give Redis a
+    maxmemory-policy such as allkeys-lru to bound its size. Keys are
+    namespaced with `prefix`.
+    """
+
+    def __init__(self, url, ttl=None, prefix='warbler:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                "RedisCache needs the redis package: pip install redis")
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+
+    def get(self, key):
+        """Return the value for `key`, or None."""
+
+        return self._client.get(self.prefix + key)
+
+    def set(self, key, value):
+        """Cache `value` under `key`."""
+
+        self._client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        """Drop `key` if present."""
+
+        self._client.delete(self.prefix + key)
+
+    def clear(self):
+        """Drop every key under this cache's prefix."""
+
+        keys = list(self._client.scan_iter(self.prefix + '*'))
+        if keys:
+            self._client.delete(*keys)
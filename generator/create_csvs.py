@@ -2,29 +2,63 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a production-sized
+dataset for benchmarks:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 100000000 --likes 50000000 --processes 8 --out /data/big
+
+Nothing is fetched over the network, and the same --seed (and --end) always
+gives the same files, however many --processes share the work. Rows are
+generated a chunk at a time and written as they're ready, so memory use
+stays flat at any size. The shape of the data:
+
+- Followers follow a power law: a few users are followed by a large share
+  of everyone, most by a handful. How many users each person follows is
+  long-tailed too.
+- Prolific users post much more than most, and posts come in bursts on top
+  of a day/night cycle, over the --days before --end.
+- Likes go mostly to a small set of popular messages.
+
+The ids in follows.csv and likes.csv assume users.csv and messages.csv are
+loaded, in order, into empty tables (as seed.py does), so their rows get
+ids 1, 2, 3...
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import io
+import os
+import time
+from datetime import date, datetime, timedelta
+from multiprocessing import Pool
+from random import Random
+
+from helpers import (Scatter, bursty_times, heavy_tailed_count, paragraph,
+                     power_law_rank, sentence, WORDS)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+NUM_LIKES = 2000
+
+CHUNK_SIZE = 10000
 
-fake = Faker()
+# Exponents of the power laws popularity is drawn from: higher is more
+# concentrated on the top few.
+FOLLOWED_EXPONENT = 1.0
+POSTING_EXPONENT = 0.8
+LIKED_EXPONENT = 1.0
 
-# Generate random profile image URLs to use for users
+# Every user's password is "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +66,171 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
+    "/static/images/nav-bg.png",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+PLACE_SUFFIXES = ['ton', 'ville', 'burgh', 'field', 'ford', ' Springs', ' Falls']
+
+
+def users_chunk(options, start, stop):
+    """Rows for the users with ids start + 1 to stop."""
+
+    rng = Random(f"{options.seed}:users:{start}")
+
+    for id in range(start + 1, stop + 1):
+        username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{id}"
+        yield [
+            f"{username}@example.com",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            sentence(rng, MAX_WARBLER_LENGTH),
+            rng.choice(header_image_urls),
+            rng.choice(WORDS).capitalize() + rng.choice(PLACE_SUFFIXES),
+        ]
+
+
+def messages_chunk(options, start, stop):
+    """Rows for the messages with ids start + 1 to stop.
+
+    Each chunk covers its share of the posting window, so message ids rise
+    with their timestamps as they would in production.
+    """
+
+    rng = Random(f"{options.seed}:messages:{start}")
+    authors = Scatter(options.users)
+
+    span = timedelta(days=options.days)
+    first = datetime.combine(options.end, datetime.min.time()) - span
+    window = span * (stop - start) / options.messages
+
+    for timestamp in bursty_times(rng, first + span * start / options.messages,
+                                  window, stop - start):
+        yield [
+            paragraph(rng, MAX_WARBLER_LENGTH),
+            timestamp,
+            authors(power_law_rank(rng, options.users, POSTING_EXPONENT)),
+        ]
+
+
+def follows_chunk(options, start, stop):
+    """Rows for the users followed by users start + 1 to stop."""
+
+    rng = Random(f"{options.seed}:follows:{start}")
+    followed = Scatter(options.users)
+    mean = options.follows / options.users
+
+    for follower in range(start + 1, stop + 1):
+        count = min(heavy_tailed_count(rng, mean), options.users - 1)
+        for user_id in sample_distinct(rng, count, lambda: followed(
+                power_law_rank(rng, options.users, FOLLOWED_EXPONENT)),
+                exclude=follower):
+            yield [user_id, follower]
+
+
+def likes_chunk(options, start, stop):
+    """Rows for the messages liked by users start + 1 to stop."""
+
+    rng = Random(f"{options.seed}:likes:{start}")
+    liked = Scatter(options.messages)
+    mean = options.likes / options.users
+
+    for user_id in range(start + 1, stop + 1):
+        count = min(heavy_tailed_count(rng, mean), options.messages)
+        for message_id in sample_distinct(rng, count, lambda: liked(
+                power_law_rank(rng, options.messages, LIKED_EXPONENT))):
+            yield [user_id, message_id]
+
+
+def sample_distinct(rng, count, draw, exclude=None):
+    """Up to `count` distinct values from `draw()`, never `exclude`.
+
+    Gives up early rather than looping forever when the distribution is
+    too concentrated to yield `count` different values.
+    """
+
+    values = set()
+    for _ in range(count * 3 + 10):
+        if len(values) == count:
+            break
+        value = draw()
+        if value != exclude:
+            values.add(value)
+    return sorted(values)
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, users_chunk, 'users'),
+    'messages': (MESSAGES_CSV_HEADERS, messages_chunk, 'messages'),
+    'follows': (FOLLOWS_CSV_HEADERS, follows_chunk, 'users'),
+    'likes': (LIKES_CSV_HEADERS, likes_chunk, 'users'),
+}
+
+
+def render_chunk(job):
+    """Generate one chunk of a table as CSV text (run in a worker)."""
+
+    table, options, start, stop = job
+    headers, rows, counted_by = TABLES[table]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    for row in rows(options, start, stop):
+        writer.writerow(row)
+        count += 1
+    return buffer.getvalue(), count
+
+
+def generate(options):
+    """Write each table's CSV into options.out, reporting progress."""
+
+    os.makedirs(options.out, exist_ok=True)
+
+    with Pool(options.processes) as pool:
+        for table, (headers, rows, counted_by) in TABLES.items():
+            total = getattr(options, counted_by)
+            jobs = [(table, options, start,
+                     min(start + options.chunk_size, total))
+                    for start in range(0, total, options.chunk_size)]
+
+            started = time.perf_counter()
+            count = 0
+            with open(os.path.join(options.out, f'{table}.csv'), 'w',
+                      newline='') as file:
+                csv.writer(file).writerow(headers)
+                for text, rows_written in pool.imap(render_chunk, jobs):
+                    file.write(text)
+                    count += rows_written
+
+            elapsed = time.perf_counter() - started
+            print(f"{table}: {count:,} rows in {elapsed:.1f}s "
+                  f"({count / max(elapsed, 1e-9):,.0f} rows/s)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS,
+                        help="roughly how many follows to generate")
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help="roughly how many likes to generate")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--days', type=int, default=730,
+                        help="how many days of posts to generate")
+    parser.add_argument('--end', type=date.fromisoformat,
+                        default=date.today(),
+                        help="day the posts end (YYYY-MM-DD; default today)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--out', default=os.path.dirname(
+        os.path.abspath(__file__)))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    generate(parse_args())
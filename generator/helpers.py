@@ -1,14 +1,136 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here draws from a random.Random passed in by the caller, so a
+given seed always produces the same data.
+"""
 
+import math
+from datetime import timedelta
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+WORDS = """
+    able about above across act add after again against age ago agree air
+    all almost alone along already also always among animal answer any
+    appear apple area arm around art ask away baby back bad ball bank base
+    beach bear beat bed before begin behind believe bell best better big
+    bird black blue boat body bone book both box boy bread break bring
+    brother brown build burn busy buy call calm camp can car care carry
+    case cat catch cause cell chair chance change charge check child city
+    claim class clean clear climb clock close cloud coast coat cold color
+    come common cook cool corn cost could count country course cover cross
+    crowd cry cup cut dance dark day dead deal dear decide deep desert
+    design dinner direct dog door down draw dream dress drink drive drop dry
+    during each early earth east easy eat edge egg end enjoy enough enter
+    even evening event ever every exact example eye face fact fair fall
+    family far farm fast father fear feel field fight fill final find fine
+    fire first fish fit floor flower fly follow food foot forest forget
+    form free fresh friend front fruit full fun game garden gate gather
+    gentle gift girl give glad glass go gold good grass great green ground
+    group grow guess half hand happy hard hat have head hear heart heat
+    heavy help here high hill hold hole home hope horse hot hour house
+    huge hunt idea inch island join joy jump keep key kind king kitchen
+    know lake land large last late laugh lead learn leave left letter level
+    light like line lion list listen little live long look lost loud love
+    low lucky machine main make many map mark market meet middle might mile
+    milk mind minute miss moment money moon morning mother mountain move
+    music name near need nest never new next nice night noise north note
+    now number ocean offer often old open order other paint paper park part
+    party pass path pay people pick picture piece place plan plant play
+    point pond poor power press pretty pull push quick quiet race rain
+    reach read ready real record red rest rich ride right ring river road
+    rock roll room rope round run safe sail salt same sand save say school
+    sea season seat second see seed send serve set shade shape share ship
+    shoe shop short shout show side sign silver simple sing sister sit
+    size skin sky sleep slow small smile snow soft soil song soon sound
+    south space speak special spring square stand star start station stay
+    step stick still stone stop store storm story street strong study
+    summer sun supper sure sweet swim table tail take talk tall taste teach
+    team tell test thank thick thin think through tiny today together tomorrow
+    tool top touch town track trade train travel tree trip true try turn
+    under until up use valley visit voice wait walk wall warm wash watch
+    water wave way wear weather week well west wheel while white whole wide
+    wild win wind window winter wish wood word work world write yard year
+    yellow young
+""".split()
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
 
-    return datetime.fromtimestamp(random_timestamp)
+def power_law_rank(rng, n, exponent):
+    """A rank from 0 to n - 1, where rank r is drawn with probability
+    roughly proportional to 1 / (r + 1) ** exponent.
+
+    Inverts the CDF of the continuous power law on [1, n + 1), so it takes
+    constant time and memory however large n is.
+    """
+
+    u = rng.random()
+    if exponent == 1:
+        x = (n + 1) ** u
+    else:
+        a = 1 - exponent
+        x = (u * ((n + 1) ** a - 1) + 1) ** (1 / a)
+    return min(int(x) - 1, n - 1)
+
+
+class Scatter:
+    """A fixed bijection of 1..n onto itself, spreading low ranks (the
+    popular users or messages) across the id range."""
+
+    def __init__(self, n):
+        self.n = n
+        self.step = 2654435761 % n or 1
+        while math.gcd(self.step, n) != 1:
+            self.step += 1
+
+    def __call__(self, rank):
+        return rank * self.step % self.n + 1
+
+
+def heavy_tailed_count(rng, mean, sigma=1.2):
+    """A non-negative count with the given mean and a long tail (most
+    users do a little, a few do a lot)."""
+
+    mu = math.log(max(mean, 1e-9)) - sigma ** 2 / 2
+    return int(rng.lognormvariate(mu, sigma) + 0.5)
+
+
+def bursty_times(rng, start, span, count, bursts=None):
+    """`count` sorted datetimes in [start, start + span), clustered.
+
+    About half the posts fall in bursts (a busy half hour after some news),
+    the rest follow a day/night cycle peaking in the evening.
+    """
+
+    seconds = span.total_seconds()
+    if bursts is None:
+        bursts = max(1, count // 200)
+    centres = [rng.uniform(0, seconds) for _ in range(bursts)]
+
+    offsets = []
+    while len(offsets) < count:
+        if rng.random() < 0.5:
+            offset = rng.choice(centres) + rng.expovariate(1 / 1800)
+        else:
+            offset = rng.uniform(0, seconds)
+            hour = (start + timedelta(seconds=offset)).hour
+            # Fewer posts at night: accept with probability 0.2 at 7am
+            # rising to 1.0 at 7pm.
+            if rng.random() > 0.6 - 0.4 * math.cos((hour - 7) * math.pi / 12):
+                continue
+        if offset < seconds:
+            offsets.append(offset)
+
+    return [start + timedelta(seconds=offset) for offset in sorted(offsets)]
+
+
+def sentence(rng, max_length):
+    """Random words as a sentence, at most `max_length` characters."""
+
+    words = [rng.choice(WORDS) for _ in range(rng.randint(4, 14))]
+    text = ' '.join(words).capitalize() + '.'
+    return text[:max_length]
+
+
+def paragraph(rng, max_length):
+    """A few sentences, cut to `max_length` characters."""
+
+    return ' '.join(sentence(rng, max_length)
+                    for _ in range(rng.randint(1, 3)))[:max_length]
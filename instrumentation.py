@@ -0,0 +1,185 @@
+"""Per-request performance instrumentation for Warbler.
+
+Each request gets a RequestTimings on g that adds up the time spent running
+SQL (from SQLAlchemy engine events), rendering templates (from Flask's
+template signals) and hashing passwords (from the PasswordHasher's
+listeners). app.py sends it back in a Server-Timing header, which browser
+dev tools show alongside the request, and adds it to a RouteMetrics, which
+serves per-route histograms in Prometheus's text format at /metrics.
+
+Metrics are kept per worker process.
+"""
+
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+from flask import before_render_template, g, has_request_context, template_rendered
+from sqlalchemy import event
+
+# Upper bounds (seconds) of the request duration histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+class RequestTimings:
+    """Where one request's time went, in seconds."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_queries = 0
+        self.sql = 0.0
+        self.templates = 0.0
+        self.bcrypt = 0.0
+        self._template_depth = 0
+        self._template_started = None
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """The value of a Server-Timing header for this request so far."""
+
+        metrics = [f'sql;dur={self.sql * 1000:.1f};'
+                   f'desc="{self.sql_queries} queries"',
+                   f'template;dur={self.templates * 1000:.1f}']
+        if self.bcrypt:
+            metrics.append(f'bcrypt;dur={self.bcrypt * 1000:.1f}')
+        metrics.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+def start_request():
+    """Start timing the current request."""
+
+    g.timings = RequestTimings()
+
+
+def current():
+    """The current request's RequestTimings, or None outside a request."""
+
+    if has_request_context():
+        return g.get('timings')
+    return None
+
+
+def watch_engine(engine):
+    """Time every statement `engine` runs during a request."""
+
+    def before(conn, cursor, statement, parameters, context, many):
+        context._timing_started = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, many):
+        timings = current()
+        if timings:
+            timings.sql_queries += 1
+            timings.sql += time.perf_counter() - context._timing_started
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+
+
+def watch_templates(app):
+    """Time template rendering in `app`'s requests.
+
+    Templates rendered from inside another (like message cards) count
+    towards the outer one only.
+    """
+
+    def before(sender, template, context, **extra):
+        timings = current()
+        if timings:
+            if not timings._template_depth:
+                timings._template_started = time.perf_counter()
+            timings._template_depth += 1
+
+    def rendered(sender, template, context, **extra):
+        timings = current()
+        if timings and timings._template_depth:
+            timings._template_depth -= 1
+            if not timings._template_depth:
+                timings.templates += (time.perf_counter()
+                                      - timings._template_started)
+
+    before_render_template.connect(before, app, weak=False)
+    template_rendered.connect(rendered, app, weak=False)
+
+
+def record_bcrypt(seconds):
+    """PasswordHasher listener adding hashing time to the request."""
+
+    timings = current()
+    if timings:
+        timings.bcrypt += seconds
+
+
+class RouteMetrics:
+    """Request counts, duration histograms and time breakdowns by route."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._requests = defaultdict(int)
+            self._histograms = defaultdict(
+                lambda: [0] * (len(self.buckets) + 1))
+            self._sums = defaultdict(lambda: defaultdict(float))
+
+    def observe(self, route, status, timings):
+        """Add a finished request's RequestTimings."""
+
+        duration = timings.elapsed()
+        with self._lock:
+            self._requests[route, status] += 1
+            self._histograms[route][bisect_left(self.buckets, duration)] += 1
+            sums = self._sums[route]
+            sums['duration'] += duration
+            sums['sql'] += timings.sql
+            sums['sql_queries'] += timings.sql_queries
+            sums['template'] += timings.templates
+            sums['bcrypt'] += timings.bcrypt
+
+    def render(self, pool=None):
+        """The metrics in Prometheus's text exposition format, plus stats
+        for the connection `pool` if given."""
+
+        with self._lock:
+            lines = ['# TYPE warbler_requests_total counter']
+            for (route, status), count in sorted(self._requests.items()):
+                lines.append(f'warbler_requests_total{{route="{route}",'
+                             f'status="{status}"}} {count}')
+
+            lines.append('# TYPE warbler_request_duration_seconds histogram')
+            for route, counts in sorted(self._histograms.items()):
+                total = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    total += count
+                    lines.append(
+                        f'warbler_request_duration_seconds_bucket'
+                        f'{{route="{route}",le="{bound}"}} {total}')
+                lines.append(f'warbler_request_duration_seconds_sum'
+                             f'{{route="{route}"}} '
+                             f'{self._sums[route]["duration"]:.6f}')
+                lines.append(f'warbler_request_duration_seconds_count'
+                             f'{{route="{route}"}} {total}')
+
+            for name, key in (('sql_seconds', 'sql'),
+                              ('sql_queries', 'sql_queries'),
+                              ('template_seconds', 'template'),
+                              ('bcrypt_seconds', 'bcrypt')):
+                lines.append(f'# TYPE warbler_request_{name}_total counter')
+                for route, sums in sorted(self._sums.items()):
+                    lines.append(f'warbler_request_{name}_total'
+                                 f'{{route="{route}"}} {sums[key]:g}')
+
+        if pool is not None and hasattr(pool, 'checkedout'):
+            for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+                lines.append(f'# TYPE warbler_db_pool_{name} gauge')
+                lines.append(f'warbler_db_pool_{name} '
+                             f'{getattr(pool, name)()}')
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,263 @@
+"""Versioned schema migrations for Warbler.
+
+Each migration is a function taking a database connection, registered in
+order with @migration; its position in MIGRATIONS is its version. Running
+`upgrade()` (or `flask db-upgrade`) applies every migration the database
+hasn't recorded in its schema_versions table yet, in one transaction.
+
+Each migration spells out its own SQL rather than building on the models,
+so what a version does stays fixed as the models change, and a database
+migrated in one go ends up like one migrated a version at a time.
+
+Migrations must be safe to run against a database that already has their
+changes, since databases created before migrations existed (or by
+db.create_all() in the tests) start with no recorded versions. Indexes are
+built with plain CREATE INDEX, which blocks writes to the table while it
+runs, so apply migrations that add indexes to large tables off-peak.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, Table, Text,
+                        inspect)
+
+from models import db, User, create_username_trigram_index
+
+schema_versions = Table(
+    'schema_versions',
+    MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """Register `func` as the next migration."""
+
+    MIGRATIONS.append(func)
+    return func
+
+
+@migration
+def create_tables(connection):
+    """Create the tables Warbler had before migrations, if missing."""
+
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            email TEXT NOT NULL UNIQUE,
+            username TEXT NOT NULL UNIQUE,
+            image_url TEXT,
+            header_image_url TEXT,
+            bio TEXT,
+            location TEXT,
+            password TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS follows (
+            user_being_followed_id INTEGER
+                REFERENCES users (id) ON DELETE CASCADE,
+            user_following_id INTEGER
+                REFERENCES users (id) ON DELETE CASCADE,
+            PRIMARY KEY (user_being_followed_id, user_following_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            text VARCHAR(140) NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE
+        );
+
+        CREATE TABLE IF NOT EXISTS likes (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+            message_id INTEGER REFERENCES messages (id) ON DELETE CASCADE,
+            UNIQUE (user_id, message_id)
+        )
+    """)
+
+
+@migration
+def add_user_counters(connection):
+    """Add the denormalized counters to users and fill them in."""
+
+    existing = {column['name'] for column in
+                inspect(connection).get_columns('users')}
+
+    for name in ('messages_count', 'following_count', 'followers_count',
+                 'likes_count'):
+        if name not in existing:
+            connection.exec_driver_sql(
+                f"ALTER TABLE users ADD COLUMN {name} "
+                f"INTEGER NOT NULL DEFAULT 0")
+
+    # Plain SQL rather than User.reconcile_counts(), which may come to use
+    # columns later migrations add.
+    connection.exec_driver_sql("""
+        UPDATE users SET
+            messages_count = (SELECT count(*) FROM messages
+                              WHERE messages.user_id = users.id),
+            following_count = (SELECT count(*) FROM follows
+                               WHERE follows.user_following_id = users.id),
+            followers_count = (SELECT count(*) FROM follows
+                               WHERE follows.user_being_followed_id = users.id),
+            likes_count = (SELECT count(*) FROM likes
+                           WHERE likes.user_id = users.id)
+    """)
+
+
+@migration
+def build_timelines(connection):
+    """Create the materialized timelines and fill them from existing
+    messages and follows, with each followed user's 800 most recent
+    messages."""
+
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS timeline_entries (
+            user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+            message_id INTEGER REFERENCES messages (id) ON DELETE CASCADE,
+            author_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id, message_id)
+        )
+    """)
+
+    connection.exec_driver_sql("DELETE FROM timeline_entries")
+    connection.exec_driver_sql("""
+        INSERT INTO timeline_entries (user_id, message_id, author_id, timestamp)
+        SELECT user_id, message_id, author_id, timestamp
+        FROM (SELECT candidates.*,
+                     row_number() OVER (PARTITION BY user_id, author_id
+                                        ORDER BY timestamp DESC) AS rank
+              FROM (SELECT user_id, id AS message_id, user_id AS author_id,
+                           timestamp
+                    FROM messages
+                    UNION ALL
+                    SELECT follows.user_following_id, messages.id,
+                           messages.user_id, messages.timestamp
+                    FROM follows
+                    JOIN messages
+                      ON messages.user_id = follows.user_being_followed_id
+                   ) AS candidates
+             ) AS ranked
+        WHERE rank <= 800
+        ON CONFLICT DO NOTHING
+    """)
+
+
+@migration
+def add_search_indexes(connection):
+    """Index usernames and warble text for search."""
+
+    create_username_trigram_index(User.__table__, connection)
+
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_messages_text_search ON messages "
+            "USING gin (to_tsvector('english'::regconfig, text))")
+
+
+@migration
+def add_hot_query_indexes(connection):
+    """Index the follows, messages, likes and timeline lookups behind the
+    hot routes (see query_plans.py)."""
+
+    connection.exec_driver_sql("""
+        CREATE INDEX IF NOT EXISTS ix_follows_user_following_id
+            ON follows (user_following_id, user_being_followed_id);
+        CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp
+            ON messages (user_id, timestamp, id);
+        CREATE INDEX IF NOT EXISTS ix_likes_message_id
+            ON likes (message_id, user_id);
+        CREATE INDEX IF NOT EXISTS ix_timeline_entries_user_id_timestamp
+            ON timeline_entries (user_id, timestamp, message_id)
+    """)
+
+
+@migration
+def add_user_versions(connection):
+    """Add the version counters the ETags are built from."""
+
+    existing = {column['name'] for column in
+                inspect(connection).get_columns('users')}
+
+    for name in ('version', 'profile_version'):
+        if name not in existing:
+            connection.exec_driver_sql(
+                f"ALTER TABLE users ADD COLUMN {name} "
+                f"INTEGER NOT NULL DEFAULT 0")
+
+
+@migration
+def add_message_likes_counts(connection):
+    """Add the denormalized like count to messages and fill it in."""
+
+    existing = {column['name'] for column in
+                inspect(connection).get_columns('messages')}
+
+    if 'likes_count' not in existing:
+        connection.exec_driver_sql(
+            "ALTER TABLE messages ADD COLUMN likes_count "
+            "INTEGER NOT NULL DEFAULT 0")
+
+    connection.exec_driver_sql("""
+        UPDATE messages SET likes_count = counts.likes
+        FROM (SELECT message_id, count(*) AS likes FROM likes
+              GROUP BY message_id) AS counts
+        WHERE messages.id = counts.message_id
+          AND messages.likes_count <> counts.likes
+    """)
+
+
+@migration
+def drop_username_prefix_index(connection):
+    """Drop the lower(username) prefix index, which user search's substring
+    match never uses."""
+
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_users_username_lower")
+
+
+def current_version(connection):
+    """The highest migration version applied to the database (0 if none)."""
+
+    schema_versions.create(connection, checkfirst=True)
+    return connection.scalar(
+        db.select(db.func.coalesce(db.func.max(schema_versions.c.version), 0)))
+
+
+def upgrade():
+    """Apply pending migrations; return the names of those applied."""
+
+    connection = db.session.connection()
+
+    if connection.dialect.name == 'postgresql':
+        # Serialize concurrent upgrades (e.g. several app servers starting).
+        connection.exec_driver_sql("SELECT pg_advisory_xact_lock(8675309)")
+
+    version = current_version(connection)
+    applied = []
+
+    for number, func in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+
+        func(connection)
+        connection.execute(schema_versions.insert().values(
+            version=number, name=func.__name__, applied_at=datetime.utcnow()))
+        applied.append(func.__name__)
+
+    db.session.commit()
+    return applied
+
+
+def drop_all():
+    """Drop every table, including the migration history."""
+
+    db.drop_all()
+    schema_versions.drop(db.engine, checkfirst=True)
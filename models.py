@@ -1,12 +1,31 @@
 """SQLAlchemy models for Warbler."""
 
+import logging
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+logger = logging.getLogger('warbler.models')
+
+# How many of a followed user's most recent messages are copied into a
+# follower's timeline when they start following (and when timelines are
+# rebuilt from scratch).
+TIMELINE_BACKFILL = 800
+
+
+def escape_like(term):
+    """Escape LIKE's wildcards in `term` (for use with escape='\\')."""
+
+    return (term.replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
 
 
 class Follows(db.Model):
@@ -26,6 +45,60 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads on the followed user ("who follows X");
+    # this serves "who does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def follow(cls, user_id, followed_ids):
+        """Have `user_id` follow the existing users in `followed_ids`,
+        other than themself.
+
+        One INSERT that skips users already followed, so it's safe to
+        repeat. Counters and timelines are updated for the new follows,
+        whose ids are returned.
+        """
+
+        rows = (db.select(User.id, db.literal(user_id))
+                .where(User.id.in_(sorted(set(followed_ids))),
+                       User.id != user_id))
+        added = db.session.scalars(
+            insert(cls)
+            .from_select(['user_being_followed_id', 'user_following_id'], rows)
+            .on_conflict_do_nothing()
+            .returning(cls.user_being_followed_id)).all()
+
+        if added:
+            for followed_id in added:
+                TimelineEntry.backfill(user_id, followed_id)
+            User.adjust_counts(user_id, following_count=len(added))
+            User.adjust_counts(added, followers_count=1)
+        return added
+
+    @classmethod
+    def unfollow(cls, user_id, followed_ids):
+        """Have `user_id` stop following `followed_ids`.
+
+        One DELETE by key, so it's safe to repeat. Returns the ids that
+        were being followed.
+        """
+
+        removed = db.session.scalars(
+            db.delete(cls)
+            .where(cls.user_following_id == user_id,
+                   cls.user_being_followed_id.in_(sorted(set(followed_ids))))
+            .returning(cls.user_being_followed_id)).all()
+
+        if removed:
+            for followed_id in removed:
+                TimelineEntry.prune(user_id, followed_id)
+            User.adjust_counts(user_id, following_count=-len(removed))
+            User.adjust_counts(removed, followers_count=-1)
+        return removed
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -49,18 +122,102 @@ class Likes(db.Model):
 
     __table_args__ =(
         db.UniqueConstraint('user_id', 'message_id'),
+        db.Index('ix_likes_message_id', 'message_id', 'user_id'),
     )
-    def add_like(user_id, message_id):
-        """Add user likes to db"""
-        new_like = Likes(
-            user_id = user_id,
-            message_id = message_id
-        )
 
-        db.session.add(new_like)
-        return new_like   
-    
-class User(db.Model):
+    @classmethod
+    def like(cls, user_id, message_ids):
+        """Have `user_id` like the existing messages in `message_ids`,
+        other than their own.
+
+        One INSERT that skips messages already liked, so it's safe to
+        repeat. Returns the ids of the new likes' messages.
+        """
+
+        rows = (db.select(db.literal(user_id), Message.id)
+                .where(Message.id.in_(sorted(set(message_ids))),
+                       Message.user_id != user_id))
+        added = db.session.scalars(
+            insert(cls)
+            .from_select(['user_id', 'message_id'], rows)
+            .on_conflict_do_nothing()
+            .returning(cls.message_id)).all()
+
+        if added:
+            User.adjust_counts(user_id, likes_count=len(added))
+            Message.adjust_likes(added, 1)
+        return added
+
+    @classmethod
+    def unlike(cls, user_id, message_ids):
+        """Remove `user_id`'s likes of `message_ids`.
+
+        One DELETE by key, so it's safe to repeat. Returns the ids of the
+        messages that were liked.
+        """
+
+        removed = db.session.scalars(
+            db.delete(cls)
+            .where(cls.user_id == user_id,
+                   cls.message_id.in_(sorted(set(message_ids))))
+            .returning(cls.message_id)).all()
+
+        if removed:
+            User.adjust_counts(user_id, likes_count=-len(removed))
+            Message.adjust_likes(removed, -1)
+        return removed
+
+class UserLookups:
+    """Queries about a user that only need the user's id.
+
+    Shared by User and UserIdentity, so pages that hold just the cached
+    identity of the logged-in user can still ask about them.
+    """
+
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Answers for a whole page of messages in one query; returns a set.
+        """
+
+        if not message_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Likes.message_id)
+            .where(Likes.user_id == self.id,
+                   Likes.message_id.in_(message_ids))))
+
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return db.session.scalar(db.select(db.exists().where(
+            Follows.user_being_followed_id == self.id,
+            Follows.user_following_id == other_user.id)))
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        return db.session.scalar(db.select(db.exists().where(
+            Follows.user_being_followed_id == other_user.id,
+            Follows.user_following_id == self.id)))
+
+    def following_ids(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Answers for a whole page of users in one query; returns a set.
+        """
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id,
+                   Follows.user_being_followed_id.in_(user_ids))))
+
+
+class User(UserLookups, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -105,7 +262,56 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts so profile stats don't load whole collections.
+    # Kept in step by the write paths via `adjust_counts` and repaired by
+    # `reconcile_counts` (`flask reconcile-counters`).
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever something shown on pages about or for this user
+    # changes (counters, likes, follows, their timeline); used for ETags.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped only when the user's profile (username, avatar...) changes.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    messages = db.relationship('Message', passive_deletes='all')
 
     followers = db.relationship(
         "User",
@@ -129,17 +335,135 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
-    def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Atomically add `deltas` to the counters of `user_ids` and bump
+        their version.
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        `user_ids` is a single id or a select of ids, e.g.
+        User.adjust_counts(user.id, followers_count=1).
+        """
 
-    def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        if isinstance(user_ids, int):
+            condition = cls.id == user_ids
+        else:
+            condition = cls.id.in_(user_ids)
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        values[cls.version] = cls.version + 1
+
+        db.session.execute(db.update(cls).where(condition).values(values))
+
+    @classmethod
+    def touch(cls, user_ids):
+        """Bump the version of `user_ids` (an id or a select of ids) after
+        a change to what their pages show."""
+
+        cls.adjust_counts(user_ids)
+
+    @classmethod
+    def versions(cls, *user_ids):
+        """Map each existing id in `user_ids` to its (version,
+        profile_version)."""
+
+        rows = db.session.execute(
+            db.select(cls.id, cls.version, cls.profile_version)
+            .where(cls.id.in_(user_ids)))
+        return {id: (version, profile_version)
+                for id, version, profile_version in rows}
+
+    @classmethod
+    def reconcile_counts(cls, user_ids=None):
+        """Recompute users' counters from the underlying tables.
+
+        Checks every user unless `user_ids` is given. Only rows that have
+        drifted are written. Returns how many were fixed.
+        """
+
+        actual = {
+            'messages_count': (db.select(db.func.count())
+                               .where(Message.user_id == cls.id)),
+            'following_count': (db.select(db.func.count())
+                                .where(Follows.user_following_id == cls.id)),
+            'followers_count': (db.select(db.func.count())
+                                .where(Follows.user_being_followed_id == cls.id)),
+            'likes_count': (db.select(db.func.count())
+                            .where(Likes.user_id == cls.id)),
+        }
+        actual = {name: query.scalar_subquery()
+                  for name, query in actual.items()}
+        drifted = db.or_(*[getattr(cls, name) != query
+                           for name, query in actual.items()])
+        if user_ids is not None:
+            drifted = db.and_(cls.id.in_(user_ids), drifted)
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(drifted)
+            .values(actual)
+            .values(version=cls.version + 1)
+            .execution_options(synchronize_session=False))
+        return result.rowcount
+
+    @classmethod
+    def following_cards(cls, user_id):
+        """Select the card columns of the users `user_id` follows.
+
+        Rows are keyed by Follows.user_being_followed_id (the same value as
+        the row's id) so pages can be cut along the follows index.
+        """
+
+        return (db.select(*cls.card_columns())
+                .join(Follows, Follows.user_being_followed_id == cls.id)
+                .where(Follows.user_following_id == user_id))
+
+    @classmethod
+    def follower_cards(cls, user_id):
+        """Select the card columns of the users following `user_id`.
+
+        Rows are keyed by Follows.user_following_id (the same value as the
+        row's id).
+        """
+
+        return (db.select(*cls.card_columns())
+                .join(Follows, Follows.user_following_id == cls.id)
+                .where(Follows.user_being_followed_id == user_id))
+
+    @classmethod
+    def card_columns(cls):
+        """The columns a user card renders."""
+
+        return (cls.id, cls.username, cls.image_url, cls.header_image_url,
+                cls.bio)
+
+    @classmethod
+    def search(cls, term):
+        """Query for users whose username contains `term`, best match first.
+
+        Exact matches rank above prefix matches, which rank above other
+        substring matches; ties go to the shorter username. Matching is
+        case-insensitive on lower(username), which Postgres serves from
+        the trigram index below where pg_trgm is installed; otherwise, and
+        on other databases, it's a scan.
+        """
+
+        term = term.strip().lower()
+        escaped = escape_like(term)
+        username = db.func.lower(cls.username)
+
+        rank = db.case(
+            (username == term, 0),
+            (username.like(f"{escaped}%", escape='\\'), 1),
+            else_=2,
+        )
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return (cls
+                .query
+                .filter(username.like(f"%{escaped}%", escape='\\'))
+                .order_by(rank,
+                          db.func.length(cls.username),
+                          cls.username))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -148,7 +472,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -163,7 +487,7 @@ class User(db.Model):
     @classmethod
     def edit_profile(cls, username, email, password, image_url, header_image_url, bio, location):
         """Edit a user profile"""
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
         updated_user = User(
             username=username,
             email=email,
@@ -185,18 +509,64 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A password hashed with an outdated work factor is rehashed; commit
+        the session to store the new hash.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
 
+@db.event.listens_for(User.__table__, 'after_create')
+def create_username_trigram_index(target, connection, **kw):
+    """Add a trigram index serving substring matches (LIKE '%abc%') on
+    lower(username), where the pg_trgm extension is available."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    try:
+        with connection.begin_nested():
+            connection.execute(db.text(
+                "CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            connection.execute(db.text(
+                "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+                "ON users USING gin (lower(username) gin_trgm_ops)"))
+    except DBAPIError as error:
+        logger.warning("Couldn't create the username trigram index, so "
+                       "user searches will scan the users table: %s",
+                       error.orig)
+
+
+class UserIdentity(UserLookups):
+    """Snapshot of the logged-in user's id, username and avatar.
+
+    Cached between requests so routes that only need these (plus the
+    id-based lookups) don't load the user from the database.
+    """
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+    @classmethod
+    def of(cls, user):
+        return cls(id=user.id, username=user.username, image_url=user.image_url)
+
+    def __repr__(self):
+        return f"<UserIdentity #{self.id}: {self.username}>"
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -215,7 +585,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -224,8 +594,274 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # How many users like this message, shown with it in every list. Kept
+    # in step by Likes.like/unlike (each an atomic increment in the same
+    # transaction as the like) and repaired by `reconcile_likes_counts`.
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    # Serves a user's messages newest first (profiles, timeline backfill).
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def adjust_likes(cls, message_ids, delta):
+        """Atomically add `delta` to the like counts of `message_ids` (a
+        list or a select of ids)."""
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(message_ids))
+            .values(likes_count=cls.likes_count + delta)
+            .execution_options(synchronize_session=False))
+
+    @classmethod
+    def reconcile_likes_counts(cls, message_ids=None):
+        """Recompute messages' like counts from the likes table.
+
+        Checks every message unless `message_ids` is given. Only rows that
+        have drifted are written. Returns how many were fixed.
+        """
+
+        actual = (db.select(db.func.count())
+                  .where(Likes.message_id == cls.id)
+                  .scalar_subquery())
+        drifted = cls.likes_count != actual
+        if message_ids is not None:
+            drifted = db.and_(cls.id.in_(message_ids), drifted)
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(drifted)
+            .values(likes_count=actual)
+            .execution_options(synchronize_session=False))
+        return result.rowcount
+
+    @classmethod
+    def by_author(cls, user_id):
+        """Query for the messages `user_id` has posted."""
+
+        return cls.query.filter(cls.user_id == user_id)
+
+    @classmethod
+    def liked_by(cls, user_id):
+        """Query for the messages `user_id` has liked."""
+
+        return (cls.query
+                .join(Likes, Likes.message_id == cls.id)
+                .filter(Likes.user_id == user_id))
+
+    @classmethod
+    def search(cls, terms, author_id=None, since=None, until=None):
+        """Query for messages matching the search `terms`.
+
+        On Postgres this is a full-text match served by the GIN index
+        below (quoted phrases, OR and -exclusions work as in web search);
+        elsewhere it falls back to a case-insensitive substring match.
+        Optionally limited to one author and to timestamps in
+        [since, until).
+        """
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            matches = message_text_vector(cls.text).bool_op('@@')(
+                db.func.websearch_to_tsquery(SEARCH_CONFIG, terms))
+        else:
+            matches = cls.text.ilike(f"%{escape_like(terms)}%",
+                                     escape='\\')
+
+        query = cls.query.filter(matches)
+        if author_id is not None:
+            query = query.filter(cls.user_id == author_id)
+        if since is not None:
+            query = query.filter(cls.timestamp >= since)
+        if until is not None:
+            query = query.filter(cls.timestamp < until)
+
+        return query
+
+
+# Text search configuration for warble search; queries must use the same
+# expression as the index for Postgres to use it.
+SEARCH_CONFIG = db.text("'english'::regconfig")
+
+
+def message_text_vector(text):
+    return db.func.to_tsvector(SEARCH_CONFIG, text)
+
+
+# Postgres maintains the index as messages are inserted and deleted.
+db.Index('ix_messages_text_search',
+         message_text_vector(Message.text),
+         postgresql_using='gin').ddl_if(dialect='postgresql')
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Entries are written when a message is posted (fan-out on write) and
+    when the follow graph changes, so the homepage reads a user's timeline
+    by key instead of scanning the messages of everyone they follow.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    @classmethod
+    def messages_for(cls, user_id):
+        """Query for the messages on `user_id`'s timeline, newest first."""
+
+        return (Message
+                .query
+                .join(cls, cls.message_id == Message.id)
+                .filter(cls.user_id == user_id)
+                .order_by(cls.timestamp.desc()))
+
+    @classmethod
+    def head(cls, user_id):
+        """(timestamp, message id) of the newest entry on `user_id`'s
+        timeline (None if it's empty), which changes whenever a new message
+        is fanned out to it."""
+
+        row = db.session.execute(
+            db.select(cls.timestamp, cls.message_id)
+            .where(cls.user_id == user_id)
+            .order_by(cls.timestamp.desc(), cls.message_id.desc())
+            .limit(1)).first()
+        return tuple(row) if row else None
+
+    @classmethod
+    def fan_out(cls, message, limit=TIMELINE_BACKFILL):
+        """Copy a newly posted (and flushed) message onto the timelines of
+        its author and everyone following the author.
+
+        Like backfill(), timelines keep only an author's `limit` most
+        recent messages, so the author's message this one pushes out of
+        that window is removed from the same timelines. Each timeline thus
+        stays within `limit` entries per user followed.
+        """
+
+        columns = ['user_id', 'message_id', 'author_id', 'timestamp']
+        recipients = (
+            db.select(db.literal(message.user_id).label('user_id'))
+            .union(db.select(Follows.user_following_id)
+                   .where(Follows.user_being_followed_id == message.user_id))
+            .subquery()
+        )
+        rows = db.select(recipients.c.user_id,
+                         db.literal(message.id),
+                         db.literal(message.user_id),
+                         db.literal(message.timestamp))
+
+        db.session.execute(
+            insert(cls).from_select(columns, rows).on_conflict_do_nothing())
+
+        expired = (db.select(Message.id)
+                   .where(Message.user_id == message.user_id)
+                   .order_by(Message.timestamp.desc(), Message.id.desc())
+                   .offset(limit)
+                   .limit(1)
+                   .scalar_subquery())
+        db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id.in_(db.select(recipients.c.user_id)),
+                   cls.message_id == expired))
+
+    @classmethod
+    def backfill(cls, user_id, followed_id, limit=TIMELINE_BACKFILL):
+        """Copy `followed_id`'s most recent messages onto `user_id`'s
+        timeline after `user_id` starts following them."""
+
+        columns = ['user_id', 'message_id', 'author_id', 'timestamp']
+        rows = (db.select(db.literal(user_id),
+                          Message.id,
+                          Message.user_id,
+                          Message.timestamp)
+                .where(Message.user_id == followed_id)
+                .order_by(Message.timestamp.desc())
+                .limit(limit))
+
+        db.session.execute(
+            insert(cls).from_select(columns, rows).on_conflict_do_nothing())
+
+    @classmethod
+    def prune(cls, user_id, followed_id):
+        """Remove `followed_id`'s messages from `user_id`'s timeline after
+        `user_id` stops following them."""
+
+        if user_id == followed_id:
+            return
+
+        db.session.execute(
+            db.delete(cls).where(cls.user_id == user_id,
+                                 cls.author_id == followed_id))
+
+    @classmethod
+    def rebuild(cls, limit=TIMELINE_BACKFILL):
+        """Rebuild every timeline from the messages and follows tables.
+
+        Used after bulk loads, which bypass the fan-out on write.
+        """
+
+        columns = ['user_id', 'message_id', 'author_id', 'timestamp']
+        own = db.select(Message.user_id.label('user_id'),
+                        Message.id.label('message_id'),
+                        Message.user_id.label('author_id'),
+                        Message.timestamp)
+        followed = (db.select(Follows.user_following_id,
+                              Message.id,
+                              Message.user_id,
+                              Message.timestamp)
+                    .join(Message,
+                          Message.user_id == Follows.user_being_followed_id))
+        candidates = own.union_all(followed).subquery()
+        ranked = db.select(
+            candidates,
+            db.func.row_number().over(
+                partition_by=(candidates.c.user_id, candidates.c.author_id),
+                order_by=candidates.c.timestamp.desc(),
+            ).label('rank'),
+        ).subquery()
+        rows = (db.select(*[ranked.c[name] for name in columns])
+                .where(ranked.c.rank <= limit))
+
+        db.session.execute(db.delete(cls))
+        db.session.execute(
+            insert(cls).from_select(columns, rows).on_conflict_do_nothing())
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,240 @@
+"""Pagination for Warbler's message and user lists.
+
+Message lists use keyset (cursor) pagination: pages are addressed by the
+(timestamp, id) of the message at their edge rather than by an OFFSET, so
+every page is a bounded index range scan no matter how far back the reader
+has scrolled, and new messages arriving at the top don't shift the pages
+below. Follower lists use the same idea keyed on user id alone. Ranked
+search results use plain numbered pages.
+"""
+
+from datetime import datetime
+
+from flask import request, url_for
+from sqlalchemy import tuple_
+
+from models import db
+
+
+def encode_cursor(timestamp, id):
+    """Turn a message's sort key into a string for use in a URL."""
+
+    return f"{timestamp.isoformat()}_{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into a (timestamp, id) sort key.
+
+    Returns None for a missing or malformed cursor, which callers treat
+    as "start from the newest message".
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        timestamp, id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(id)
+    except ValueError:
+        return None
+
+
+def _page_url(drop, **cursor):
+    """URL of the current page's endpoint with `cursor` in place of the
+    query args named in `drop`.
+
+    Other query args are kept, except ones that would clash with the
+    route's own arguments or that url_for() treats specially (those
+    starting with an underscore).
+    """
+
+    args = {key: value for key, value in request.args.items()
+            if key not in drop and key not in request.view_args
+            and not key.startswith('_')}
+    return url_for(request.endpoint, **request.view_args, **args, **cursor)
+
+
+class Page:
+    """One page of messages plus cursors to its neighbours."""
+
+    def __init__(self, items, older=None, newer=None):
+        self.items = items
+        self.older = older
+        self.newer = newer
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def older_url(self):
+        """URL of the next page of older messages, or None."""
+
+        return self._url(before=self.older) if self.older else None
+
+    def newer_url(self):
+        """URL of the previous page of newer messages, or None."""
+
+        return self._url(after=self.newer) if self.newer else None
+
+    def _url(self, **cursor):
+        return _page_url(('before', 'after'), **cursor)
+
+
+def paginate(query, timestamp_col, id_col, per_page, before=None, after=None):
+    """Return a Page of `query`'s results ordered newest first.
+
+    `timestamp_col` and `id_col` are the columns the query is keyed on;
+    they must match the `timestamp` and `id` of the items it returns.
+    `before` and `after` are cursor strings from a previous Page.
+    """
+
+    key = tuple_(timestamp_col, id_col)
+    query = query.order_by(None)
+    after = decode_cursor(after)
+    before = decode_cursor(before)
+
+    if after:
+        rows = (query
+                .filter(key > after)
+                .order_by(timestamp_col.asc(), id_col.asc())
+                .limit(per_page + 1)
+                .all())
+
+        # Near the top there may not be a full page of newer messages;
+        # show the newest page instead of a short one.
+        if len(rows) < per_page:
+            return paginate(query, timestamp_col, id_col, per_page)
+
+        items = list(reversed(rows[:per_page]))
+        has_newer = len(rows) > per_page
+        has_older = True
+
+    else:
+        if before:
+            query = query.filter(key < before)
+
+        rows = (query
+                .order_by(timestamp_col.desc(), id_col.desc())
+                .limit(per_page + 1)
+                .all())
+
+        items = rows[:per_page]
+        has_newer = before is not None
+        has_older = len(rows) > per_page
+
+    older = newer = None
+    if items and has_older:
+        older = encode_cursor(items[-1].timestamp, items[-1].id)
+    if items and has_newer:
+        newer = encode_cursor(items[0].timestamp, items[0].id)
+
+    return Page(items, older=older, newer=newer)
+
+
+class NumberedPage:
+    """One numbered page of results."""
+
+    def __init__(self, items, number, has_next):
+        self.items = items
+        self.number = number
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def prev_url(self):
+        """URL of the previous page, or None on the first page."""
+
+        return self._url(self.number - 1) if self.number > 1 else None
+
+    def next_url(self):
+        """URL of the next page, or None on the last page."""
+
+        return self._url(self.number + 1) if self.has_next else None
+
+    def _url(self, number):
+        return _page_url(('page',), page=number)
+
+
+def paginate_numbered(query, page, per_page):
+    """Return page number `page` (from 1) of `query`'s ordered results."""
+
+    page = max(page, 1)
+    rows = (query
+            .limit(per_page + 1)
+            .offset((page - 1) * per_page)
+            .all())
+
+    return NumberedPage(rows[:per_page], page, has_next=len(rows) > per_page)
+
+
+class IdPage:
+    """One page of a list ordered by ascending id."""
+
+    def __init__(self, items, prev=None, next=None):
+        self.items = items
+        self.prev = prev
+        self.next = next
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def prev_url(self):
+        """URL of the previous page, or None on the first page."""
+
+        return self._url(before=self.prev) if self.prev else None
+
+    def next_url(self):
+        """URL of the next page, or None on the last page."""
+
+        return self._url(after=self.next) if self.next else None
+
+    def _url(self, **cursor):
+        return _page_url(('before', 'after'), **cursor)
+
+
+def paginate_ids(select, id_col, per_page, before=None, after=None):
+    """Return an IdPage of the rows of `select`, ordered by `id_col`.
+
+    `before` and `after` are ids from a previous IdPage; each row's `id`
+    must equal its `id_col`.
+    """
+
+    if before:
+        rows = db.session.execute(select
+                                  .where(id_col < before)
+                                  .order_by(id_col.desc())
+                                  .limit(per_page + 1)).all()
+
+        # Near the start there may not be a full page; show the first.
+        if len(rows) < per_page:
+            return paginate_ids(select, id_col, per_page)
+
+        items = list(reversed(rows[:per_page]))
+        has_prev = len(rows) > per_page
+        has_next = True
+
+    else:
+        if after:
+            select = select.where(id_col > after)
+
+        rows = db.session.execute(select
+                                  .order_by(id_col)
+                                  .limit(per_page + 1)).all()
+
+        items = rows[:per_page]
+        has_prev = after is not None
+        has_next = len(rows) > per_page
+
+    prev = items[0].id if items and has_prev else None
+    next = items[-1].id if items and has_next else None
+
+    return IdPage(items, prev=prev, next=next)
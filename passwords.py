@@ -0,0 +1,143 @@
+"""Password hashing for Warbler, optionally run in a pool of worker processes.
+
+A bcrypt hash or check takes hundreds of milliseconds of CPU. Doing it in
+a separate process keeps that work off the request's worker (and its
+GIL), and bounding the pool and its queue means a burst of logins gets
+turned away with PasswordHasherBusy instead of tying up every worker.
+
+The hashes are ordinary bcrypt hashes ($2b$<cost>$...), interchangeable
+with Flask-Bcrypt's. needs_rehash() tells callers when a stored hash was
+made with a different cost from the configured one, so it can be replaced
+the next time the user logs in.
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashes are already queued or running."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+class PasswordHasher:
+    """Hashes and checks passwords with bcrypt in a process pool.
+
+    `rounds` is bcrypt's log2 work factor. At most `workers` hashes run
+    at once and at most `max_queue` are running or waiting; beyond that
+    calls raise PasswordHasherBusy straight away. `workers=0` (the
+    default) hashes in the calling thread, for scripts and tests.
+
+    The pool starts on the first hash, in spawned processes, which import
+    the calling program's __main__ module; scripts that hash with a pool
+    must keep their top level under `if __name__ == '__main__':`.
+
+    Each callable in `listeners` is called with the seconds every hash or
+    check took, including its wait in the queue.
+    """
+
+    def __init__(self, rounds=12, workers=0, max_queue=None):
+        self.listeners = []
+        self._pool = None
+        self._pool_pid = None
+        self._lock = Lock()
+        self.configure(rounds, workers, max_queue)
+
+    def configure(self, rounds=12, workers=0, max_queue=None):
+        """Change the settings; takes effect for the next hash."""
+
+        if max_queue is None:
+            max_queue = workers * 8
+
+        with self._lock:
+            self.rounds = rounds
+            self.workers = workers
+            self.max_queue = max_queue
+            self._slots = BoundedSemaphore(max_queue)
+            self._shutdown_pool()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Return whether `password` matches the bcrypt hash `hashed`."""
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Whether `hashed` was made with a cost other than the configured
+        one (or isn't a bcrypt hash at all)."""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def close(self):
+        """Shut down the worker processes; they restart on the next hash."""
+
+        with self._lock:
+            self._shutdown_pool()
+
+    def _run(self, func, *args):
+        started = time.perf_counter()
+        try:
+            return self._call(func, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            for listener in self.listeners:
+                listener(elapsed)
+
+    def _call(self, func, *args):
+        if not self.workers:
+            return func(*args)
+
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            return self._get_pool().submit(func, *args).result()
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool for the next caller.
+            with self._lock:
+                self._shutdown_pool()
+            raise
+        finally:
+            slots.release()
+
+    def _get_pool(self):
+        with self._lock:
+            # Pools don't survive a fork (e.g. gunicorn --preload), so each
+            # process starts its own on first use.
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _shutdown_pool(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown(wait=False)
+        self._pool = None
+        self._pool_pid = None
+
+
+hasher = PasswordHasher()
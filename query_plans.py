@@ -0,0 +1,161 @@
+"""EXPLAIN checks for the queries behind Warbler's hot routes.
+
+`check()` (or `flask check-query-plans`) asks Postgres to plan each query
+with sequential scans disabled. If a query still gets a Seq Scan, no index
+can serve it and it will slow down as its table grows. Turning seqscans off
+makes the check meaningful on small development and test databases, where
+the planner would otherwise scan tiny tables regardless of the indexes.
+
+The statements mirror what the routes run (see app.py); keep them in step
+when a route's query changes.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from models import db, User, Message, Likes, Follows, TimelineEntry
+
+PAGE = 101
+SAMPLE_IDS = list(range(1, PAGE))
+
+
+def hot_queries(user_id=1, message_id=1):
+    """The hot routes' statements by name, with sample parameters."""
+
+    cursor = (datetime.utcnow(), message_id)
+
+    queries = {
+        'homepage: timeline page':
+            TimelineEntry.messages_for(user_id)
+            .filter(tuple_(TimelineEntry.timestamp,
+                           TimelineEntry.message_id) < cursor)
+            .order_by(None)
+            .order_by(TimelineEntry.timestamp.desc(),
+                      TimelineEntry.message_id.desc())
+            .limit(PAGE),
+
+        'homepage: timeline head (ETag)':
+            db.select(TimelineEntry.timestamp, TimelineEntry.message_id)
+            .where(TimelineEntry.user_id == user_id)
+            .order_by(TimelineEntry.timestamp.desc(),
+                      TimelineEntry.message_id.desc())
+            .limit(1),
+
+        'users_show: profile messages page':
+            Message.query
+            .filter(Message.user_id == user_id,
+                    tuple_(Message.timestamp, Message.id) < cursor)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(PAGE),
+
+        'timelines: liked message ids':
+            db.select(Likes.message_id)
+            .where(Likes.user_id == user_id,
+                   Likes.message_id.in_(SAMPLE_IDS)),
+
+        'user lists: followed user ids':
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id,
+                   Follows.user_being_followed_id.in_(SAMPLE_IDS)),
+
+        'show_following: following page':
+            User.following_cards(user_id)
+            .where(Follows.user_being_followed_id > user_id)
+            .order_by(Follows.user_being_followed_id)
+            .limit(PAGE),
+
+        'users_followers: followers page':
+            User.follower_cards(user_id)
+            .where(Follows.user_following_id > user_id)
+            .order_by(Follows.user_following_id)
+            .limit(PAGE),
+
+        'show_likes: liked messages':
+            db.select(Message)
+            .join(Likes, Likes.message_id == Message.id)
+            .where(Likes.user_id == user_id),
+
+        'list_users: users page':
+            User.query.order_by(User.username).limit(PAGE),
+
+        'messages_search: text search':
+            Message.search('warble')
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(PAGE),
+
+        'add_follow: timeline backfill':
+            db.select(Message.id, Message.timestamp)
+            .where(Message.user_id == user_id)
+            .order_by(Message.timestamp.desc())
+            .limit(800),
+
+        'messages_add: fan-out recipients':
+            db.select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id),
+
+        'messages_add: message leaving timelines':
+            db.select(Message.id)
+            .where(Message.user_id == user_id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .offset(800)
+            .limit(1),
+
+        'messages_destroy: likers of a message':
+            db.select(Likes.user_id)
+            .where(Likes.message_id == message_id),
+    }
+
+    # Substring matches are only index-backed where pg_trgm is installed.
+    if has_index('users', 'ix_users_username_trgm'):
+        queries['list_users: username search'] = (
+            User.search('warbler').limit(PAGE))
+
+    return queries
+
+
+def has_index(table, name):
+    return name in {index['name'] for index in
+                    db.inspect(db.session.connection()).get_indexes(table)}
+
+
+def explain(statement):
+    """Return Postgres's JSON plan for `statement`."""
+
+    if hasattr(statement, 'statement'):
+        statement = statement.statement
+
+    connection = db.session.connection()
+    sql = statement.compile(dialect=connection.dialect,
+                            compile_kwargs={'literal_binds': True})
+    return connection.exec_driver_sql(
+        f"EXPLAIN (FORMAT JSON) {sql}").scalar()[0]['Plan']
+
+
+def seq_scans(plan):
+    """Names of the relations `plan` reads with a sequential scan."""
+
+    found = []
+    if plan['Node Type'] == 'Seq Scan':
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def check():
+    """Plan every hot query; return {name: [seq-scanned tables]} for the
+    ones that can't avoid a sequential scan."""
+
+    failures = {}
+
+    try:
+        db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+        for name, query in hot_queries().items():
+            scanned = seq_scans(explain(query))
+            if scanned:
+                failures[name] = scanned
+    finally:
+        db.session.rollback()
+
+    return failures
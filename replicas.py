@@ -0,0 +1,63 @@
+"""Read-replica routing for Warbler.
+
+The models' session is a RoutingSession: during a request that app.py has
+pointed at a replica (by setting g.read_replica), its SELECTs go to that
+replica's engine, while flushes and INSERT/UPDATE/DELETE statements still
+go to the primary. Everything outside a request uses the primary.
+
+app.py only sends reads to a replica for GET, HEAD and OPTIONS requests
+from users who haven't written anything in the last few seconds, so
+people always see their own changes even though the replicas lag slightly
+behind.
+"""
+
+import random
+
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Delete, Insert, Update, create_engine
+
+
+class Replicas:
+    """The engines of the replicas reads may be sent to."""
+
+    def __init__(self):
+        self.engines = []
+        # Called with each replica engine as it's created, so instrumentation
+        # can watch replicas as well as the primary.
+        self.listeners = []
+
+    def configure(self, urls=(), **engine_options):
+        """Replace the replicas with ones at `urls`."""
+
+        self.dispose()
+        self.engines = [create_engine(url, **engine_options) for url in urls]
+        for engine in self.engines:
+            for listener in self.listeners:
+                listener(engine)
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = []
+
+    def choose(self):
+        """A replica engine to read from, or None if there are none."""
+
+        return random.choice(self.engines) if self.engines else None
+
+
+replicas = Replicas()
+
+
+class RoutingSession(Session):
+    """Sends the current request's reads to its replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = g.get('read_replica') if has_request_context() else None
+
+        if (replica is not None and bind is None and not self._flushing
+                and not isinstance(clause, (Insert, Update, Delete))):
+            return replica
+
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
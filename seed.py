@@ -1,20 +1,35 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
+Streams the CSVs in SEED_DIR (default: generator/) into a fresh database
+with bulk_load; SEED_CHUNK_SIZE sets how many rows are sent at a time.
+likes.csv is optional. Make bigger datasets with generator/create_csvs.py.
+"""
+
+import os
+
+import bulk_load
+import migrations
 from app import db
-from models import User, Message, Follows
+from models import User, Message, TimelineEntry
 
+SEED_DIR = os.environ.get('SEED_DIR', 'generator')
 
-db.drop_all()
-db.create_all()
+migrations.drop_all()
+migrations.upgrade()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+files = {table: os.path.join(SEED_DIR, f'{table}.csv')
+         for table in ('users', 'messages', 'follows', 'likes')}
+if not os.path.exists(files['likes']):
+    del files['likes']
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+bulk_load.load(
+    files,
+    chunk_size=int(os.environ.get('SEED_CHUNK_SIZE', bulk_load.CHUNK_SIZE)))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+# Bulk loads skip the write paths that maintain timelines and counters,
+# so build those in one pass each.
+TimelineEntry.rebuild()
+User.reconcile_counts()
+Message.reconcile_likes_counts()
 
 db.session.commit()
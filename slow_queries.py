@@ -0,0 +1,182 @@
+"""Slow-query log for Warbler.
+
+A SlowQueryLog watches an engine and writes every statement that takes
+longer than `threshold_ms` to a rotating log file, one JSON object per
+line, with its bind parameters and the route that ran it. Statements over
+`explain_ms` also get their Postgres plan (EXPLAIN ANALYZE if `analyze`
+is set, for SELECTs only, since it runs the query again).
+
+summarize() groups the entries by fingerprint (the statement with its
+literals and parameters blanked out) so that `flask slow-queries` can
+list the worst offenders.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+# Parameters whose values never go in the log
+SECRET_PARAMETER = re.compile(r'password|secret|token', re.IGNORECASE)
+
+
+class SlowQueryLog:
+    """Logs statements slower than `threshold_ms` to `path`."""
+
+    def __init__(self, path, threshold_ms=250, explain_ms=1000, analyze=False,
+                 max_bytes=10 * 1024 * 1024, backups=5):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self.explain_ms = explain_ms
+        self.analyze = analyze
+
+        self.logger = logging.getLogger(f'warbler.slow_queries.{path}')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            self.logger.addHandler(RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups, delay=True))
+
+    def watch(self, engine):
+        """Start timing `engine`'s statements."""
+
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def unwatch(self, engine):
+        event.remove(engine, 'before_cursor_execute', self._before)
+        event.remove(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, many):
+        context._slow_query_started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, many):
+        ms = (time.perf_counter() - context._slow_query_started) * 1000
+        if self.threshold_ms is None or ms < self.threshold_ms:
+            return
+
+        entry = {
+            'time': datetime.utcnow().isoformat(),
+            'ms': round(ms, 1),
+            'route': request.endpoint if has_request_context() else None,
+            'fingerprint': fingerprint(statement),
+            'statement': statement,
+            'parameters': redact(parameters, many),
+        }
+
+        # Plans are fetched through a second psycopg2 cursor; other drivers
+        # (asyncpg on the async path) get no plan.
+        if (self.explain_ms is not None and ms >= self.explain_ms
+                and not many and conn.dialect.driver == 'psycopg2'):
+            entry['plan'] = self.explain(cursor, statement, parameters)
+
+        self.logger.info(json.dumps(entry, default=str))
+
+    def explain(self, cursor, statement, parameters):
+        """Postgres's JSON plan for `statement`, or None if it can't be
+        explained."""
+
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+            return None
+
+        options = 'ANALYZE, BUFFERS, ' if self.analyze and verb == 'SELECT' else ''
+        try:
+            explain = cursor.connection.cursor()
+        except Exception:
+            return None
+
+        # A failed EXPLAIN mustn't abort the request's transaction
+        try:
+            explain.execute("SAVEPOINT slow_query_explain")
+            try:
+                explain.execute(
+                    f"EXPLAIN ({options}FORMAT JSON) {statement}", parameters)
+                plan = explain.fetchone()[0]
+                explain.execute("RELEASE SAVEPOINT slow_query_explain")
+                return plan
+            except Exception:
+                explain.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                return None
+        finally:
+            explain.close()
+
+
+def redact(parameters, many=False):
+    """`parameters` with the values of secret-looking ones hidden (only
+    the first few sets of an executemany)."""
+
+    if many:
+        return [redact(each) for each in list(parameters)[:5]]
+    if isinstance(parameters, dict):
+        return {name: '***' if SECRET_PARAMETER.search(name) else value
+                for name, value in parameters.items()}
+    return parameters
+
+
+LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|\?|:\w+'), '?'),
+    (re.compile(r'\b\d+(\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def fingerprint(statement):
+    """A short id for `statement`'s shape, the same whatever its
+    literals and parameters (and however many values are in its IN
+    lists)."""
+
+    normalized = statement.strip()
+    for pattern, replacement in LITERALS:
+        normalized = pattern.sub(replacement, normalized)
+
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def read_entries(path):
+    """The entries in the log at `path` and its rotated backups."""
+
+    for name in sorted(glob.glob(f'{glob.escape(path)}*')):
+        with open(name) as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarize(entries, sort='total'):
+    """Group log entries by fingerprint, worst first.
+
+    Each group has the fingerprint, count, total_ms, max_ms, the routes
+    that ran it, a sample statement and the slowest plan captured. `sort`
+    is 'total', 'max' or 'count'.
+    """
+
+    groups = defaultdict(lambda: {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                  'routes': set(), 'plan': None})
+
+    for entry in entries:
+        group = groups[entry['fingerprint']]
+        group['fingerprint'] = entry['fingerprint']
+        group['statement'] = entry['statement']
+        group['count'] += 1
+        group['total_ms'] += entry['ms']
+        if entry.get('route'):
+            group['routes'].add(entry['route'])
+        if entry['ms'] >= group['max_ms']:
+            group['max_ms'] = entry['ms']
+            group['plan'] = entry.get('plan') or group['plan']
+
+    key = {'total': 'total_ms', 'max': 'max_ms', 'count': 'count'}[sort]
+    return sorted(groups.values(), key=lambda group: group[key], reverse=True)
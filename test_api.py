@@ -0,0 +1,174 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api.py
+
+
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, identity_cache
+
+db.create_all()
+
+
+class APITestCase(TestCase):
+    """Tests for the /api/v1 routes."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        identity_cache.clear()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("reader", "reader@test.com", "password", None)
+        self.author = User.signup("writer", "writer@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+        self.author_id = self.author.id
+
+        start = datetime(2024, 1, 1)
+        for i in range(5):
+            msg = Message(text=f"warble {i}", user_id=self.author_id,
+                          timestamp=start + timedelta(minutes=i))
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.user_id))
+        db.session.flush()
+        TimelineEntry.backfill(self.user_id, self.author_id)
+        db.session.commit()
+
+        self.old_page_size = app.config['API_PAGE_SIZE']
+        app.config['API_PAGE_SIZE'] = 2
+
+    def tearDown(self):
+        app.config['API_PAGE_SIZE'] = self.old_page_size
+        db.session.rollback()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_timeline_pages(self):
+        """The timeline comes a page at a time, newest first"""
+        with self.client as client:
+            self.login(client)
+
+            texts = []
+            cursor = None
+            while True:
+                response = client.get("/api/v1/timeline",
+                                      query_string={'cursor': cursor} if cursor else {})
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(response.json['items']), 2)
+                texts += [item['text'] for item in response.json['items']]
+                cursor = response.json['next_cursor']
+                if not cursor:
+                    break
+
+            self.assertEqual(texts, [f"warble {i}" for i in range(4, -1, -1)])
+            self.assertEqual(response.json['items'][0]['user']['username'],
+                             "writer")
+
+    def test_timeline_requires_login(self):
+        response = self.client.get("/api/v1/timeline")
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('error', response.json)
+
+    def test_ndjson_stream(self):
+        """Asking for NDJSON streams every item, across pages"""
+        with self.client as client:
+            self.login(client)
+            response = client.get(f"/api/v1/users/{self.author_id}/messages",
+                                  headers={'Accept': 'application/x-ndjson'})
+
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = response.text.splitlines()
+            self.assertEqual([json.loads(line)['text'] for line in lines],
+                             [f"warble {i}" for i in range(4, -1, -1)])
+
+    def test_profile_and_follow_lists(self):
+        with self.client as client:
+            self.login(client)
+
+            response = client.get(f"/api/v1/users/{self.author_id}")
+            self.assertEqual(response.json['username'], "writer")
+            self.assertIn('followers_count', response.json)
+
+            response = client.get(f"/api/v1/users/{self.author_id}/followers")
+            self.assertEqual([user['username'] for user in response.json['items']],
+                             ["reader"])
+            self.assertIsNone(response.json['next_cursor'])
+
+            response = client.get(f"/api/v1/users/{self.user_id}/following")
+            self.assertEqual([user['id'] for user in response.json['items']],
+                             [self.author_id])
+
+            for url in ("/api/v1/users/999999",
+                        "/api/v1/users/999999/messages",
+                        "/api/v1/users/999999/following",
+                        "/api/v1/users/999999/followers",
+                        "/api/v1/users/999999/likes"):
+                response = client.get(url)
+                self.assertEqual(response.status_code, 404)
+                self.assertIn('error', response.json)
+
+    def test_likes(self):
+        message_id = db.session.scalar(db.select(db.func.min(Message.id)))
+        db.session.add(Likes(user_id=self.user_id, message_id=message_id))
+        db.session.commit()
+
+        with self.client as client:
+            self.login(client)
+            response = client.get(f"/api/v1/users/{self.user_id}/likes",
+                                  query_string={'format': 'ndjson'})
+            self.assertEqual([json.loads(line)['id']
+                              for line in response.text.splitlines()],
+                             [message_id])
+
+    def test_batch(self):
+        """A batch applies its changes together, and repeating it changes
+        nothing"""
+        message_ids = db.session.scalars(
+            db.select(Message.id).order_by(Message.id)).all()
+        changes = {'like': message_ids[:3] + [999999],
+                   'unfollow': [self.author_id]}
+
+        with self.client as client:
+            self.login(client)
+            response = client.post("/api/v1/batch", json=changes)
+            self.assertEqual(response.json, {'liked': message_ids[:3],
+                                             'unfollowed': [self.author_id]})
+
+            response = client.post("/api/v1/batch", json=changes)
+            self.assertEqual(response.json, {'liked': [], 'unfollowed': []})
+
+            response = client.post("/api/v1/batch", json={'like': "1"})
+            self.assertEqual(response.status_code, 400)
+
+            # Nobody follows themself or likes their own messages
+            own = Message(text="my own", user_id=self.user_id)
+            db.session.add(own)
+            db.session.commit()
+            response = client.post("/api/v1/batch",
+                                   json={'like': [own.id],
+                                         'follow': [self.user_id]})
+            self.assertEqual(response.json, {'liked': [], 'followed': []})
+
+        user = db.session.get(User, self.user_id)
+        db.session.refresh(user)
+        self.assertEqual(user.likes_count, 3)
+        self.assertEqual(user.followers_count, 0)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.user_id)
+                         .count(), 0)
@@ -0,0 +1,155 @@
+"""Async serving tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_async_app.py
+
+
+import asyncio
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Message, User, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, identity_cache, fragment_cache
+import async_app
+import slow_queries
+
+db.create_all()
+
+
+class AsyncAppTestCase(TestCase):
+    """Tests for the asyncio serving path."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        identity_cache.clear()
+        fragment_cache.clear()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@test.com",
+                                  "password", None) for i in range(3)]
+        db.session.commit()
+        self.user_ids = [user.id for user in self.users]
+
+        for user_id in self.user_ids:
+            msg = Message(text=f"hello from {user_id}", user_id=user_id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.add(Follows(user_being_followed_id=self.user_ids[1],
+                               user_following_id=self.user_ids[0]))
+        db.session.flush()
+        TimelineEntry.backfill(self.user_ids[0], self.user_ids[1])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def run_async(self, requests):
+        """Make (user id, url) `requests` to the async app concurrently;
+        return their responses' status codes and text."""
+
+        async def get(user_id, url):
+            client = async_app.app.test_client()
+            async with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            response = await client.get(url)
+            return response.status_code, await response.get_data(as_text=True)
+
+        async def run():
+            try:
+                return await asyncio.gather(*[get(*request)
+                                              for request in requests])
+            finally:
+                await async_app.engine.dispose()
+
+        return asyncio.run(run())
+
+    def test_pages_match_flask(self):
+        """The async app serves the Flask app's pages"""
+        user_id = self.user_ids[0]
+        message_id = db.session.scalar(db.select(db.func.min(Message.id)))
+        urls = ["/", f"/users/{user_id}", f"/messages/{message_id}",
+                f"/users/{user_id}/following", f"/users/{user_id}/followers"]
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        expected = [(response.status_code, response.text)
+                    for response in map(client.get, urls)]
+        db.session.rollback()
+
+        self.assertEqual(self.run_async([(user_id, url) for url in urls]),
+                         expected)
+
+    def test_concurrent_requests_kept_apart(self):
+        """Requests in flight together each see their own user, and none
+        of them use the sync engine"""
+        sync_statements = []
+
+        def record(conn, cursor, statement, *args):
+            sync_statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            responses = self.run_async([(user_id, "/")
+                                        for user_id in self.user_ids * 3])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertFalse(sync_statements)
+        for user_id, (status, html) in zip(self.user_ids * 3, responses):
+            self.assertEqual(status, 200)
+            self.assertIn(f"@user{self.user_ids.index(user_id)}</p>", html)
+
+    def test_slow_queries_logged(self):
+        """Slow statements on the async path are logged, without plans"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'slow.log')
+
+        log = slow_queries.SlowQueryLog(path, threshold_ms=0, explain_ms=0)
+        log.watch(async_app.engine.sync_engine)
+        try:
+            (status, html), = self.run_async([(self.user_ids[0], "/")])
+        finally:
+            log.unwatch(async_app.engine.sync_engine)
+            for handler in log.logger.handlers:
+                handler.close()
+
+        self.assertEqual(status, 200)
+        with open(path) as file:
+            entries = [json.loads(line) for line in file]
+        self.assertTrue(entries)
+        self.assertTrue(all('plan' not in entry for entry in entries))
+
+    def test_route_statement_timeouts(self):
+        """Transactions get their route's statement timeout"""
+        app.config['STATEMENT_TIMEOUTS']['homepage'] = 1234
+        self.addCleanup(app.config['STATEMENT_TIMEOUTS'].clear)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(async_app.engine.sync_engine, 'before_cursor_execute',
+                     record)
+        try:
+            (status, html), = self.run_async([(self.user_ids[0], "/")])
+        finally:
+            event.remove(async_app.engine.sync_engine,
+                         'before_cursor_execute', record)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(statements[0], "SET LOCAL statement_timeout = 1234")
+
+    def test_other_routes_not_served(self):
+        (status, html), = self.run_async([(self.user_ids[0], "/signup")])
+        self.assertEqual(status, 404)
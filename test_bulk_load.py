@@ -0,0 +1,92 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import bulk_load
+
+db.create_all()
+
+
+class BulkLoadTestCase(TestCase):
+    """Tests for loading CSV files with bulk_load."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+        self.write('users.csv',
+                   'email,username,password,bio\n'
+                   + ''.join(f'u{i}@test.com,user{i},HASHED_PASSWORD,"Hi, I\'m\n{i}"\n'
+                             for i in range(1, 8)))
+        self.write('messages.csv',
+                   'text,timestamp,user_id\n'
+                   + ''.join(f'warble {i},2020-01-0{i} 12:00:00,{i}\n'
+                             for i in range(1, 8)))
+        self.write('follows.csv',
+                   'user_being_followed_id,user_following_id\n1,2\n1,3\n2,1\n')
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def write(self, name, text):
+        with open(os.path.join(self.dir.name, name), 'w') as file:
+            file.write(text)
+
+    def files(self):
+        return {table: os.path.join(self.dir.name, f'{table}.csv')
+                for table in ('users', 'messages', 'follows')}
+
+    def test_load(self):
+        """Are the rows loaded in chunks, with progress reported?"""
+        reports = []
+        counts = bulk_load.load(self.files(), chunk_size=3,
+                                report=reports.append)
+
+        self.assertEqual(counts, {'users': 7, 'messages': 7, 'follows': 3})
+        self.assertEqual(User.query.count(), 7)
+        self.assertEqual(db.session.get(User, 3).bio, "Hi, I'm\n3")
+        self.assertEqual(db.session.get(User, 3).image_url,
+                         "/static/images/default-pic.png")
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertIn('users: 6 rows', ' '.join(reports))
+        self.assertIn('Loaded 17 rows', reports[-1])
+
+    def test_restores_indexes_and_sequences(self):
+        """Are indexes, constraints and sequences back in place afterwards?"""
+        indexes = db.inspect(db.engine).get_indexes('messages')
+        foreign_keys = db.inspect(db.engine).get_foreign_keys('follows')
+
+        bulk_load.load(self.files(), report=lambda line: None)
+
+        self.assertEqual(db.inspect(db.engine).get_indexes('messages'),
+                         indexes)
+        self.assertEqual(db.inspect(db.engine).get_foreign_keys('follows'),
+                         foreign_keys)
+
+        user = User.signup("newuser", "new@test.com", "password", None)
+        db.session.add(Message(text="after the load", user=user))
+        db.session.commit()
+        self.assertEqual(user.id, 8)
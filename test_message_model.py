@@ -1,7 +1,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -82,3 +82,34 @@ class MessageModelTestCase(TestCase):
         
 
         
+
+    def test_likes_count(self):
+        """Is a message's like count kept in step with its likes, and
+        repaired by reconcile_likes_counts?"""
+        users = [User(email=f"liker{i}@test.com", username=f"liker{i}",
+                      password="HASHED_PASSWORD") for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        m1 = Message(text="Like me", user_id=users[3].id)
+        db.session.add(m1)
+        db.session.commit()
+
+        def likes_count():
+            return db.session.scalar(
+                db.select(Message.likes_count).where(Message.id == m1.id))
+
+        for user in users[:3]:
+            Likes.like(user.id, [m1.id])
+        Likes.like(users[0].id, [m1.id])
+        db.session.commit()
+        self.assertEqual(likes_count(), 3)
+
+        Likes.unlike(users[1].id, [m1.id])
+        Likes.unlike(users[1].id, [m1.id])
+        db.session.commit()
+        self.assertEqual(likes_count(), 2)
+
+        db.session.execute(db.update(Message).values(likes_count=10))
+        self.assertEqual(Message.reconcile_likes_counts(), 1)
+        self.assertEqual(likes_count(), 2)
+        self.assertEqual(Message.reconcile_likes_counts(), 0)
@@ -6,9 +6,12 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from sqlalchemy import event
+
+from models import db, connect_db, Message, User, Follows, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, identity_cache, fragment_cache, card_key
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +44,8 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        identity_cache.clear()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -96,6 +101,71 @@ class MessageViewTestCase(TestCase):
 
             self.assertIn("Hello", html)
     
+    def test_add_message_fans_out(self):
+        """Does a new message land on the author's and followers' timelines?"""
+
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+        msg = Message.query.filter_by(text="Fanned out").one()
+        timeline_owners = {entry.user_id for entry in
+                           TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(timeline_owners, {self.testuser_id, self.u1_id})
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+            self.assertIn("Fanned out", resp.text)
+
+    def test_fan_out_keeps_timelines_bounded(self):
+        """Does fan-out drop the author's messages that fall out of the
+        backfill window?"""
+
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=self.u1_id))
+        messages = []
+        for i in range(4):
+            msg = Message(text=f"Warble {i}", user_id=self.testuser_id,
+                          timestamp=datetime(2024, 1, 1, i))
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg, limit=2)
+            messages.append(msg.id)
+        db.session.commit()
+
+        for user_id in (self.testuser_id, self.u1_id):
+            self.assertEqual(
+                {entry.message_id for entry in
+                 TimelineEntry.query.filter_by(user_id=user_id)},
+                set(messages[-2:]))
+
+    def test_search_messages(self):
+        """Does full-text search find warbles by their words?"""
+
+        with self.client as client:
+            html = client.get('/messages/search?q=cheeses').text
+            self.assertIn('I love cheese!', html)
+            self.assertNotIn('Dogs are the best', html)
+
+            html = client.get('/messages/search?q=dog&author=testuser').text
+            self.assertNotIn('Dogs are the best', html)
+            self.assertIn('no warbles found', html)
+
+            html = client.get('/messages/search?q=dog&author=abc').text
+            self.assertIn('Dogs are the best', html)
+
+            html = client.get('/messages/search?q=dog&until=2000-01-01').text
+            self.assertNotIn('Dogs are the best', html)
+
     def test_unauthorized_add_message(self):
         """Test user can not add message if not signed in"""
 
@@ -117,6 +187,9 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('I love cheese!', html)
 
+            resp = client.get('/messages/999999')
+            self.assertEqual(resp.status_code, 404)
+
     def test_destroy_message(self):
         """Test message deletion"""
 
@@ -128,7 +201,84 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('Dogs are the best', html)
+
+    def test_destroy_others_message(self):
+        """Can a user only delete their own messages?"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            messages_count = db.session.get(User, self.u1_id).messages_count
+            resp = client.post('/messages/1987/delete')
+            self.assertEqual(resp.status_code, 403)
+
+            db.session.expire_all()
+            self.assertIsNotNone(db.session.get(Message, 1987))
+            self.assertEqual(db.session.get(User, self.u1_id).messages_count,
+                             messages_count)
+
+            resp = client.post('/messages/999999/delete')
+            self.assertEqual(resp.status_code, 404)
     
+    def test_like_counts_shown(self):
+        """Lists show each message's like count without a query per
+        message"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        def profile_statements():
+            statements.clear()
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                resp = c.get(f'/users/{self.u1_id}')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            return resp, len(statements)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post('/users/add_like/670')
+
+            resp, few = profile_statements()
+            self.assertRegex(resp.text, r'fa-thumbs-up"></i> 1\s')
+            self.assertRegex(resp.text, r'fa-thumbs-up"></i> 0\s')
+
+            db.session.add_all([Message(text=f"More {i}", user_id=self.u1_id)
+                                for i in range(5)])
+            db.session.commit()
+            resp, many = profile_statements()
+            self.assertEqual(many, few)
+
+    def test_message_cards_cached(self):
+        """Cards are rendered once, keep the like button per viewer, and
+        are dropped when their message is deleted"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post('/users/add_like/670')
+            resp = c.get(f'/users/{self.u1_id}')
+            self.assertIn('action="/users/delete_like/670"', resp.text)
+
+        key = card_key(670, 0)
+        self.assertIn('I love cheese!', fragment_cache.get(key))
+        self.assertNotIn('like', fragment_cache.get(key))
+
+        fragment_cache.set(key, 'cached card')
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = c.get(f'/users/{self.u1_id}')
+            self.assertIn('cached card', resp.text)
+            self.assertNotIn('action="/users/delete_like/670"', resp.text)
+
+            c.post('/messages/670/delete')
+        self.assertIsNone(fragment_cache.get(key))
+
     def test_unauthorized_destroy_message(self):
         """Test user can not delete msg if not signed in"""
         with self.client as client:
@@ -0,0 +1,87 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import migrations
+import query_plans
+
+db.create_all()
+
+
+def schema():
+    """The columns, keys and indexes of the models' tables, as the database
+    has them."""
+
+    inspector = db.inspect(db.engine)
+    return {
+        table: (
+            [(column['name'], str(column['type']), column['nullable'],
+              column['default']) for column in inspector.get_columns(table)],
+            inspector.get_pk_constraint(table)['constrained_columns'],
+            sorted(tuple(constraint['column_names']) for constraint in
+                   inspector.get_unique_constraints(table)),
+            sorted((tuple(key['constrained_columns']), key['referred_table'],
+                    key['options'].get('ondelete', '').upper())
+                   for key in inspector.get_foreign_keys(table)),
+            sorted((index['name'], tuple(map(str, index['column_names'])))
+                   for index in inspector.get_indexes(table)),
+        )
+        for table in db.metadata.tables
+    }
+
+
+class MigrationsTestCase(TestCase):
+    """Tests for migrations and the hot-query plan check."""
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_upgrade_is_idempotent(self):
+        """Does a second upgrade find nothing left to apply?"""
+        migrations.upgrade()
+
+        self.assertEqual(migrations.upgrade(), [])
+        self.assertEqual(migrations.current_version(db.session.connection()),
+                         len(migrations.MIGRATIONS))
+
+    def test_fresh_upgrade_matches_models(self):
+        """Does migrating an empty database build the models' schema?"""
+        db.session.rollback()
+        migrations.drop_all()
+        migrations.upgrade()
+        migrated = schema()
+
+        migrations.drop_all()
+        db.create_all()
+        self.assertEqual(migrated, schema())
+
+    def test_hot_queries_use_indexes(self):
+        """Can every hot route's query be served without a seq scan?"""
+        migrations.upgrade()
+
+        self.assertEqual(query_plans.check(), {})
+
+    def test_check_reports_seq_scans(self):
+        """Does the check notice a query no index can serve?"""
+        plan = query_plans.explain(db.select(User.id).where(User.bio == 'x'))
+
+        self.assertEqual(query_plans.seq_scans(plan), ['users'])
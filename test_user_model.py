@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
+from passwords import PasswordHasher, PasswordHasherBusy, hasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -108,6 +109,11 @@ class UserModelTestCase(TestCase):
 
         self.assertTrue(u2.is_followed_by(u1))
         self.assertFalse(u1.is_followed_by(u2))
+
+        #bulk lookup answers for several users at once
+        self.assertEqual(u1.following_ids([u1.id, u2.id]), {u2.id})
+        self.assertEqual(u2.following_ids([u1.id, u2.id]), set())
+        self.assertEqual(u1.following_ids([]), set())
     
     def test_signup(self):
         # Test if User.signup successfully creates a new user given valid credentials
@@ -135,4 +141,56 @@ class UserModelTestCase(TestCase):
         self.assertFalse(User.authenticate('nottestuser3', 'TestPwd'))
         
         # Test if User.authenticate fails to return a user when the password is invalid
-        self.assertFalse(User.authenticate('testuser3', 'NotTestPwd'))
\ No newline at end of file
+        self.assertFalse(User.authenticate('testuser3', 'NotTestPwd'))
+
+    def test_rehash_on_login(self):
+        """Does logging in upgrade a hash made with an old work factor?"""
+        rounds = hasher.rounds
+        self.addCleanup(hasher.configure, rounds, hasher.workers,
+                        hasher.max_queue)
+
+        hasher.configure(4, hasher.workers, hasher.max_queue)
+        user = User.signup("rehashuser", "rehash@test.com", "TestPwd", None)
+        db.session.commit()
+        self.assertTrue(user.password.startswith("$2b$04$"))
+
+        hasher.configure(5, hasher.workers, hasher.max_queue)
+        self.assertFalse(User.authenticate("rehashuser", "WrongPwd"))
+        self.assertTrue(user.password.startswith("$2b$04$"))
+
+        self.assertEqual(User.authenticate("rehashuser", "TestPwd"), user)
+        self.assertTrue(user.password.startswith("$2b$05$"))
+        self.assertEqual(User.authenticate("rehashuser", "TestPwd"), user)
+
+    def test_hasher_queue_limit(self):
+        """Are hashes past the queue limit turned away?"""
+        busy = PasswordHasher(rounds=4, workers=1, max_queue=1)
+        self.addCleanup(busy.close)
+        busy._slots.acquire()
+        with self.assertRaises(PasswordHasherBusy):
+            busy.hash("TestPwd")
+
+        busy._slots.release()
+        self.assertTrue(busy.check(busy.hash("TestPwd"), "TestPwd"))
+        self.assertFalse(busy.check(busy.hash("TestPwd"), "WrongPwd"))
+
+    def test_reconcile_counts(self):
+        """Does reconcile_counts repair counters that have drifted?"""
+        u1 = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD2")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        m1 = Message(text="counted", user_id=u2.id)
+        db.session.add_all([m1, Follows(user_being_followed_id=u2.id, user_following_id=u1.id)])
+        db.session.commit()
+        db.session.add(Likes(user_id=u1.id, message_id=m1.id))
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counts(), 2)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual((u1.following_count, u1.likes_count, u1.messages_count), (1, 1, 0))
+        self.assertEqual((u2.followers_count, u2.messages_count), (1, 1))
+        self.assertEqual(User.reconcile_counts(), 0)
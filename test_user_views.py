@@ -1,8 +1,13 @@
+import html
 import os
+import re
+import tempfile
+from datetime import datetime
 from unittest import TestCase
 from flask import session
+from sqlalchemy import event, text
 
-from models import db, User, Message, Follows, Likes
+from models import db, User, Message, Follows, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -14,7 +19,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import (app, CURR_USER_KEY, PRIMARY_UNTIL_KEY, identity_cache,
+                 fragment_cache)
+from replicas import replicas
+import slow_queries
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -24,12 +32,18 @@ db.create_all()
 
 app.app_context().push()
 
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
 class UserViewsTestCase(TestCase):
     """Tests for view functions"""
     def setUp(self):
         """Add sample user"""
         db.drop_all()
         db.create_all()
+        identity_cache.clear()
+        fragment_cache.clear()
 
         db.session.commit()
 
@@ -116,6 +130,42 @@ class UserViewsTestCase(TestCase):
             self.assertNotIn("@abc", html)
             self.assertNotIn("@ghi", html)
     
+    def test_users_search_ranking(self):
+        """Exact matches come first, then prefixes, then other substrings"""
+        User.signup('atestuser', "test5@test.com", "password", None)
+        db.session.commit()
+
+        with self.client as client:
+            html = client.get("/users?q=TestUser").text
+            positions = [html.index(f"@{name}<") for name in
+                         ("testuser", "atestuser")]
+            self.assertEqual(positions, sorted(positions))
+
+            html = client.get("/users?q=test").text
+            positions = [html.index(f"@{name}<") for name in
+                         ("testuser", "testdoguser", "atestuser")]
+            self.assertEqual(positions, sorted(positions))
+
+    def test_users_search_escapes_wildcards(self):
+        with self.client as client:
+            html = client.get("/users?q=%25").text
+            self.assertIn("Sorry, no users found", html)
+
+    def test_list_users_paginates(self):
+        app.config['USERS_PER_PAGE'] = 2
+        self.addCleanup(app.config.__setitem__, 'USERS_PER_PAGE', 48)
+
+        with self.client as client:
+            first = client.get("/users").text
+            self.assertIn("@abc<", first)
+            self.assertIn("@def<", first)
+            self.assertNotIn("@ghi<", first)
+            self.assertIn("page=2", first)
+
+            second = client.get("/users?page=2").text
+            self.assertIn("@ghi<", second)
+            self.assertNotIn("@abc<", second)
+
     def test_user_show(self):
         with self.client as client:
             response = client.get(f"/users/{self.u1_id}")
@@ -132,6 +182,10 @@ class UserViewsTestCase(TestCase):
         db.session.add_all([f1, f2, f3])
         db.session.commit()
 
+        # rows added directly skip the counter upkeep in the routes
+        User.reconcile_counts()
+        db.session.commit()
+
     def test_user_show_with_follows(self):
         self.setup_followers()
 
@@ -174,6 +228,50 @@ class UserViewsTestCase(TestCase):
             self.assertIn('@abc', html)
             self.assertNotIn('@testdoguser', html)
 
+    def test_list_users_follow_state(self):
+        """Follow buttons reflect follow state without a query per card"""
+        self.setup_followers()
+        self.count_queries("/users")
+        queries = self.count_queries("/users")
+
+        with self.client as client:
+            html = client.get("/users").text
+            self.assertIn('action="/users/stop-following/1000"', html)
+            self.assertIn('action="/users/stop-following/2000"', html)
+            self.assertIn('action="/users/follow/1"', html)
+
+        for i in range(3):
+            User.signup(f"extra{i}", f"extra{i}@test.com", "password", None)
+        db.session.commit()
+        self.assertEqual(self.count_queries("/users"), queries)
+
+    def test_followers_paginate(self):
+        """Follower lists come a page at a time, keyed on user id"""
+        app.config['USERS_PER_PAGE'] = 2
+        self.addCleanup(app.config.__setitem__, 'USERS_PER_PAGE', 48)
+
+        for follower in (self.u1, self.u2, self.u3, self.u4):
+            db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                                   user_following_id=follower.id))
+        db.session.commit()
+        ids = sorted(u.id for u in (self.u1, self.u2, self.u3, self.u4))
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            first = client.get(f"/users/{self.testuser_id}/followers").text
+            self.assertIn(f'href="/users/{ids[1]}"', first)
+            self.assertNotIn(f'href="/users/{ids[2]}"', first)
+            self.assertNotIn("Previous", first)
+
+            second = client.get(f"/users/{self.testuser_id}/followers?after={ids[1]}").text
+            self.assertIn(f'href="/users/{ids[2]}"', second)
+            self.assertIn(f'href="/users/{ids[3]}"', second)
+            self.assertNotIn(f'href="/users/{ids[0]}"', second)
+            self.assertIn(f"before={ids[2]}", second)
+            self.assertNotIn("Next", second)
+
     def test_unauthorized_following_page_access(self):
         self.setup_followers()
         with self.client as client:
@@ -206,6 +304,9 @@ class UserViewsTestCase(TestCase):
 
         db.session.add(l1)
         db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
     
     def test_user_show_with_likes(self):
         self.setup_likes()
@@ -257,6 +358,545 @@ class UserViewsTestCase(TestCase):
             likes = Likes.query.filter(Likes.message_id==m.id).all()
             self.assertEqual(len(likes), 0) 
 
+    def test_follow_backfills_timeline(self):
+        """Following a user copies their messages onto your timeline"""
+        m1 = Message(text="Backfilled warble", user_id=self.u1_id)
+        db.session.add(m1)
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            client.post(f"/users/follow/{self.u1_id}")
+            entries = TimelineEntry.query.filter_by(user_id=self.testuser_id).all()
+            self.assertEqual([e.message_id for e in entries], [m1.id])
+
+            response = client.get("/")
+            self.assertIn("Backfilled warble", response.text)
+
+    def test_unfollow_prunes_timeline(self):
+        """Unfollowing a user removes their messages from your timeline"""
+        m1 = Message(text="Soon to be pruned", user_id=self.u1_id)
+        db.session.add(m1)
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            client.post(f"/users/follow/{self.u1_id}")
+            client.post(f"/users/stop-following/{self.u1_id}")
+
+            entries = TimelineEntry.query.filter_by(user_id=self.testuser_id).all()
+            self.assertEqual(entries, [])
+
+            response = client.get("/")
+            self.assertNotIn("Soon to be pruned", response.text)
+
+    def test_likes_and_follows_idempotent(self):
+        """Repeating a like, unlike, follow or unfollow changes nothing"""
+        m1 = Message(text="Like me twice", user_id=self.u1_id)
+        db.session.add(m1)
+        db.session.commit()
+        message_id = m1.id
+
+        def counts(user_id):
+            user = db.session.get(User, user_id)
+            db.session.refresh(user)
+            return user.following_count, user.followers_count, user.likes_count
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            for _ in range(2):
+                client.post(f"/users/follow/{self.u1_id}")
+                client.post(f"/users/add_like/{message_id}")
+            self.assertEqual(counts(self.testuser_id), (1, 0, 1))
+            self.assertEqual(counts(self.u1_id), (0, 1, 0))
+            self.assertEqual(Follows.query.count(), 1)
+            self.assertEqual(Likes.query.count(), 1)
+
+            for _ in range(2):
+                client.post(f"/users/stop-following/{self.u1_id}")
+                client.post(f"/users/delete_like/{message_id}")
+            self.assertEqual(counts(self.testuser_id), (0, 0, 0))
+            self.assertEqual(counts(self.u1_id), (0, 0, 0))
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(Likes.query.count(), 0)
+
+            response = client.post("/users/follow/999999")
+            self.assertEqual(response.status_code, 404)
+
+    def test_user_show_paginates(self):
+        """Profile messages are split into keyset-paginated pages"""
+        app.config['MESSAGES_PER_PAGE'] = 2
+        self.addCleanup(app.config.__setitem__, 'MESSAGES_PER_PAGE', 100)
+
+        for i in range(5):
+            db.session.add(Message(text=f"warble number {i}", user_id=self.u1_id,
+                                   timestamp=datetime(2023, 1, i + 1)))
+        db.session.commit()
+
+        with self.client as client:
+            first = client.get(f"/users/{self.u1_id}").text
+            self.assertIn("warble number 4", first)
+            self.assertIn("warble number 3", first)
+            self.assertNotIn("warble number 2", first)
+            self.assertNotIn("Newer", first)
+
+            older = re.search(r'href="([^"]*before=[^"]*)"', first).group(1)
+            second = client.get(html.unescape(older)).text
+            self.assertIn("warble number 2", second)
+            self.assertIn("warble number 1", second)
+            self.assertNotIn("warble number 3", second)
+            self.assertIn("Newer", second)
+
+            newer = re.search(r'href="([^"]*after=[^"]*)"', second).group(1)
+            back = client.get(html.unescape(newer)).text
+            self.assertIn("warble number 4", back)
+            self.assertNotIn("warble number 2", back)
+
+            # Query args naming route arguments or url_for() options are
+            # left out of the page links.
+            response = client.get(f"/users/{self.u1_id}",
+                                  query_string={'user_id': 1,
+                                                '_external': 1})
+            self.assertEqual(response.status_code, 200)
+            older = re.search(r'href="([^"]*before=[^"]*)"', response.text).group(1)
+            self.assertTrue(older.startswith(f"/users/{self.u1_id}?"))
+            self.assertNotIn("user_id", older)
+            self.assertNotIn("_external", older)
+
+    def test_follow_updates_counters(self):
+        """Following and unfollowing keep both users' counters in step"""
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            client.post(f"/users/follow/{self.u1_id}")
+            self.assertEqual(db.session.get(User, self.testuser_id).following_count, 1)
+            self.assertEqual(db.session.get(User, self.u1_id).followers_count, 1)
+
+            client.post(f"/users/stop-following/{self.u1_id}")
+            db.session.expire_all()
+            self.assertEqual(db.session.get(User, self.testuser_id).following_count, 0)
+            self.assertEqual(db.session.get(User, self.u1_id).followers_count, 0)
+
+    def test_delete_user(self):
+        """Deleting an account leaves its rows to the database's cascades
+        and fixes the counters of the users it touched"""
+        message = Message(text="mine", user_id=self.testuser_id)
+        liked = Message(text="theirs", user_id=self.u1_id)
+        db.session.add_all([message, liked])
+        db.session.flush()
+        db.session.add_all([
+            Follows(user_being_followed_id=self.u1_id,
+                    user_following_id=self.testuser_id),
+            Follows(user_being_followed_id=self.testuser_id,
+                    user_following_id=self.u1_id),
+            Likes(user_id=self.u1_id, message_id=message.id),
+            Likes(user_id=self.testuser_id, message_id=liked.id),
+        ])
+        db.session.commit()
+        User.reconcile_counts()
+        Message.reconcile_likes_counts()
+        db.session.commit()
+        liked_id = liked.id
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                client.post("/users/delete")
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertFalse([s for s in statements
+                          if s.startswith(('DELETE FROM follows',
+                                           'DELETE FROM likes'))])
+
+        db.session.expire_all()
+        self.assertIsNone(db.session.get(User, self.testuser_id))
+        u1 = db.session.get(User, self.u1_id)
+        self.assertEqual((u1.following_count, u1.followers_count,
+                          u1.likes_count), (0, 0, 0))
+        self.assertEqual(db.session.get(Message, liked_id).likes_count, 0)
+
+    def test_liked_message_ids(self):
+        """Liked state for a page of messages comes back as a set"""
+        self.setup_likes()
+        other = Message.query.filter(Message.text == "Coffee is great").one()
+
+        testuser = db.session.get(User, self.testuser_id)
+        self.assertEqual(testuser.liked_message_ids([670, other.id]), {670})
+        self.assertEqual(testuser.liked_message_ids([]), set())
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            response = client.get(f"/users/{self.u1_id}")
+            self.assertIn('action="/users/delete_like/670"', response.text)
+
+    def count_queries(self, url):
+        """GET `url` as testuser and return how many statements it ran"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                response = client.get(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def test_timeline_loads_authors_eagerly(self):
+        """Rendering the timeline doesn't cost a query per author"""
+        for strategy in ('selectin', 'joined'):
+            app.config['LOADER_STRATEGIES']['homepage'] = strategy
+            self.addCleanup(app.config['LOADER_STRATEGIES'].clear)
+
+            Message.query.delete()
+            db.session.commit()
+            db.session.add_all([Message(text="one author", user_id=self.u1_id),
+                                Follows(user_being_followed_id=self.u1_id,
+                                        user_following_id=self.testuser_id)])
+            db.session.commit()
+            TimelineEntry.rebuild()
+            db.session.commit()
+            one_author = self.count_queries("/")
+
+            db.session.add_all([Message(text="second author", user_id=self.u2_id),
+                                Message(text="third author", user_id=self.testuser_id),
+                                Follows(user_being_followed_id=self.u2_id,
+                                        user_following_id=self.testuser_id)])
+            db.session.commit()
+            TimelineEntry.rebuild()
+            db.session.commit()
+            three_authors = self.count_queries("/")
+
+            self.assertEqual(one_author, three_authors, strategy)
+            Follows.query.delete()
+            db.session.commit()
+
+    def test_identity_only_route_uses_cache(self):
+        """Identity-only routes skip loading the user once it is cached"""
+        self.assertGreater(self.count_queries("/messages/new"), 0)
+        self.assertEqual(self.count_queries("/messages/new"), 0)
+
+    def test_deleted_user_cannot_write(self):
+        """Writes look the user up rather than trusting a cached identity,
+        which a deleted account may still have on other workers"""
+        message = Message(text="like me", user_id=self.u1_id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        self.count_queries("/messages/new")
+        db.session.execute(db.delete(User).where(User.id == self.testuser_id))
+        db.session.commit()
+        self.assertIsNotNone(identity_cache.get(self.testuser_id))
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            response = client.post(f"/users/add_like/{message_id}")
+            self.assertEqual(response.status_code, 302)
+
+            response = client.post("/api/v1/batch", json={'like': [message_id]})
+            self.assertEqual(response.status_code, 401)
+
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_profile_edit_invalidates_identity(self):
+        """Editing a profile drops the cached identity"""
+        self.count_queries("/messages/new")
+        self.assertIsNotNone(identity_cache.get(self.testuser_id))
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            client.post(f"/users/profile/{self.testuser_id}/edit",
+                        data={'username': 'renameduser', 'email': 'messagetest@test.com',
+                              'password': 'HASHED_PASSWORD'})
+            self.assertIsNone(identity_cache.get(self.testuser_id))
+
+            response = client.get("/messages/new")
+            self.assertIn('alt="renameduser"', response.text)
+
+    def revalidate(self, client, url):
+        """GET `url` twice, the second time with the first's ETag; return
+        the second response"""
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.get_etag()[0])
+        return client.get(url, headers={'If-None-Match': response.headers['ETag']})
+
+    def test_unchanged_pages_not_modified(self):
+        """Pages answer 304 to a matching ETag without running their queries"""
+        message = Message(text="cached", user_id=self.u1_id)
+        db.session.add_all([message, Follows(user_being_followed_id=self.u1_id,
+                                             user_following_id=self.testuser_id)])
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            for url in ("/", f"/users/{self.u1_id}", f"/messages/{message.id}"):
+                response = self.revalidate(client, url)
+                self.assertEqual(response.status_code, 304, url)
+                self.assertEqual(response.data, b"", url)
+                self.assertEqual(response.headers['Cache-Control'],
+                                 'private, no-cache')
+
+        with self.client as client:
+            response = self.revalidate(client, "/")
+            self.assertEqual(response.status_code, 304)
+
+    def test_changes_invalidate_etags(self):
+        """Liking, posting and profile edits change the affected pages' ETags"""
+        message = Message(text="cached", user_id=self.u1_id)
+        db.session.add_all([message, Follows(user_being_followed_id=self.u1_id,
+                                             user_following_id=self.testuser_id)])
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+        message_id = message.id
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            home = client.get("/").headers['ETag']
+            profile = client.get(f"/users/{self.u1_id}").headers['ETag']
+
+            client.post(f"/users/add_like/{message_id}")
+            response = client.get("/", headers={'If-None-Match': home})
+            self.assertEqual(response.status_code, 200)
+            home = response.headers['ETag']
+
+            # Liking again flashes a message, which mustn't be cached
+            client.post(f"/users/add_like/{message_id}")
+            response = client.get("/", headers={'If-None-Match': home})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("You already liked this message!", response.text)
+            self.assertNotIn('ETag', response.headers)
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            client.post("/messages/new", data={'text': "new warble"})
+            client.post(f"/users/profile/{self.u1_id}/edit",
+                        data={'username': 'renamed', 'email': 'test1@test.com',
+                              'password': 'password'})
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            response = client.get("/", headers={'If-None-Match': home})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("@renamed", response.text)
+
+            response = client.get(f"/users/{self.u1_id}",
+                                  headers={'If-None-Match': profile})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("new warble", response.text)
+
+    def test_forms_not_stored(self):
+        """Pages without validators are never stored"""
+        with self.client as client:
+            response = client.get("/signup")
+            self.assertNotIn('ETag', response.headers)
+            self.assertIn('no-store', response.headers['Cache-Control'])
+
+    def test_server_timing_and_metrics(self):
+        """Requests report their SQL and template time and are counted in
+        /metrics"""
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            response = client.get("/")
+            timing = response.headers['Server-Timing']
+            self.assertRegex(timing, r'sql;dur=[\d.]+;desc="\d+ queries"')
+            self.assertRegex(timing, r'template;dur=[\d.]+')
+            self.assertNotIn('bcrypt', timing)
+
+            response = client.post("/login", data={'username': 'testuser',
+                                                   'password': 'HASHED_PASSWORD'})
+            self.assertIn('bcrypt;dur=', response.headers['Server-Timing'])
+
+            metrics = client.get("/metrics").text
+            self.assertIn('warbler_requests_total{route="homepage",status="200"}',
+                          metrics)
+            self.assertIn('warbler_request_duration_seconds_bucket'
+                          '{route="login",le="+Inf"}', metrics)
+            self.assertIn('warbler_db_pool_checkedout', metrics)
+
+            response = client.get("/metrics",
+                                  environ_base={'REMOTE_ADDR': '10.0.0.1'})
+            self.assertEqual(response.status_code, 404)
+
+            app.config['METRICS_TOKEN'] = 'sesame'
+            self.addCleanup(app.config.__setitem__, 'METRICS_TOKEN', None)
+            self.assertEqual(client.get("/metrics").status_code, 404)
+            response = client.get("/metrics",
+                                  headers={'Authorization': 'Bearer sesame'})
+            self.assertEqual(response.status_code, 200)
+
+    def test_slow_query_log(self):
+        """Slow statements are logged with their route, parameters and plan,
+        and summarized by fingerprint"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'slow.log')
+
+        log = slow_queries.SlowQueryLog(path, threshold_ms=0, explain_ms=0,
+                                        analyze=True)
+        log.watch(db.engine)
+        try:
+            with self.client as client:
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.testuser_id
+                client.get(f"/users/{self.u1_id}")
+                client.get(f"/users/{self.u2_id}")
+        finally:
+            log.unwatch(db.engine)
+
+        entries = list(slow_queries.read_entries(path))
+        self.assertTrue(entries)
+        self.assertEqual({entry['route'] for entry in entries}, {'users_show'})
+        self.assertTrue(any(entry['plan'][0]['Plan'].get('Actual Rows') is not None
+                            for entry in entries if entry.get('plan')))
+
+        # The same statements for either user share fingerprints
+        pages = [group for group in slow_queries.summarize(entries)
+                 if 'FROM messages' in group['statement']]
+        self.assertEqual([group['count'] for group in pages], [2])
+        self.assertEqual(slow_queries.fingerprint("SELECT 1 WHERE id IN (%(a)s, %(b)s)"),
+                         slow_queries.fingerprint("SELECT 2 WHERE id IN (%(c)s)"))
+
+        self.assertEqual(slow_queries.redact({'password': 'x', 'id': 1}),
+                         {'password': '***', 'id': 1})
+
+    def test_statement_timeouts(self):
+        """Routes' transactions get their statement timeout, and a
+        cancelled statement answers 503"""
+        app.config['STATEMENT_TIMEOUTS']['list_users'] = 1500
+        self.addCleanup(app.config['STATEMENT_TIMEOUTS'].clear)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.client.get("/users")
+            self.assertIn("SET LOCAL statement_timeout = 1500", statements)
+
+            # Routes without a timeout clear one left on an open transaction
+            statements.clear()
+            db.session.execute(text("SELECT 1"))
+            self.client.get(f"/users/{self.u1_id}")
+            self.assertIn("SET LOCAL statement_timeout = 0", statements)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        # With the users table locked by another connection, the route's
+        # query waits on the lock until its timeout cancels it.
+        app.config['STATEMENT_TIMEOUTS']['list_users'] = 100
+        db.session.rollback()
+        with db.engine.connect() as locker:
+            locker.exec_driver_sql("LOCK TABLE users IN ACCESS EXCLUSIVE MODE")
+            try:
+                response = self.client.get("/users")
+            finally:
+                locker.rollback()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_read_replica_routing(self):
+        """Reads go to the replica, except just after the user writes"""
+        # A second engine on the test database stands in for a replica
+        replicas.configure([db.engine.url])
+        self.addCleanup(replicas.configure)
+
+        statements = {db.engine: [], replicas.engines[0]: []}
+
+        def recorder(engine):
+            def record(conn, cursor, statement, *args):
+                statements[engine].append(statement)
+            event.listen(engine, 'before_cursor_execute', record)
+            self.addCleanup(event.remove, engine, 'before_cursor_execute',
+                            record)
+
+        for engine in statements:
+            recorder(engine)
+
+        def reads(engine):
+            return [s for s in statements[engine] if s.startswith('SELECT')]
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            client.get(f"/users/{self.u1_id}")
+            self.assertTrue(reads(replicas.engines[0]))
+            self.assertFalse(reads(db.engine))
+
+            statements[replicas.engines[0]].clear()
+            client.post(f"/users/follow/{self.u1_id}")
+            self.assertFalse(statements[replicas.engines[0]])
+            self.assertEqual(len(Follows.query.all()), 1)
+
+            statements[db.engine].clear()
+            client.get(f"/users/{self.u1_id}")
+            self.assertTrue(reads(db.engine))
+            self.assertFalse(statements[replicas.engines[0]])
+
+            with client.session_transaction() as sess:
+                sess[PRIMARY_UNTIL_KEY] = 0
+
+            statements[db.engine].clear()
+            client.get(f"/users/{self.u1_id}")
+            self.assertTrue(reads(replicas.engines[0]))
+            self.assertFalse(reads(db.engine))
+
+            # A route's timeout reaches the replica connection held open
+            # from the last request, too
+            app.config['STATEMENT_TIMEOUTS']['users_show'] = 2500
+            self.addCleanup(app.config['STATEMENT_TIMEOUTS'].clear)
+            statements[replicas.engines[0]].clear()
+            client.get(f"/users/{self.u1_id}")
+            self.assertIn("SET LOCAL statement_timeout = 2500",
+                          statements[replicas.engines[0]])
+
     def test_unauthorized_like(self):
         self.setup_likes()
         with self.client as client: